@@ -0,0 +1,181 @@
+import pandas as pd
+import numpy as np
+
+import json
+import os
+
+manifest_name = 'manifest.json'
+
+
+def flatten(data, prefix=()):
+    '''
+    Flatten nested dictionaries.
+
+    inputs:
+        data = The nested dictionaries.
+        prefix = The keys of the parent dictionaries.
+
+    outputs:
+        flat = A dictionary of key paths to values that are not
+               dictionaries.
+    '''
+
+    flat = {}
+    for key, value in data.items():
+        key = prefix+(key,)
+
+        if isinstance(value, dict):
+            flat.update(flatten(value, key))
+        else:
+            flat[key] = value
+
+    return flat
+
+
+def unflatten(flat):
+    '''
+    Undo flatten.
+
+    inputs:
+        flat = A dictionary from flatten.
+
+    outputs:
+        data = The nested dictionaries.
+    '''
+
+    data = {}
+    for keys, value in flat.items():
+
+        parent = data
+        for i in keys[:-1]:
+            parent = parent.setdefault(i, {})
+
+        parent[keys[-1]] = value
+
+    return data
+
+
+def save(path, data, compress=False):
+    '''
+    Save arrays as binary files with a manifest. Uncompressed arrays are
+    one .npy file each so they can be memory mapped when loaded.
+
+    inputs:
+        path = The directory to save in.
+        data = A DataFrame or a (nested) dictionary of arrays. Text
+               columns are saved as integer codes and their categories.
+               Values that are not arrays (e.g. ragged lists) go in the
+               manifest.
+        compress = Whether to save one compressed .npz file instead.
+    '''
+
+    os.makedirs(path, exist_ok=True)
+
+    table = isinstance(data, pd.DataFrame)
+    if not table:
+        data = flatten(data)
+
+    manifest = {'table': table, 'compress': compress, 'entries': []}
+    arrays = {}
+    for count, key in enumerate(data):
+
+        entry = {'name': key}
+        value = data[key]
+
+        try:
+            values = np.asarray(value)
+        except ValueError:
+            values = None  # Ragged lists
+
+        if (values is None) or (values.ndim == 0):
+            if isinstance(value, np.generic):
+                value = value.item()
+
+            entry['value'] = value
+            manifest['entries'].append(entry)
+            continue
+
+        if values.dtype.kind in 'OUS':
+
+            # Text as codes with -1 for missing values
+            missing = pd.isna(values)
+            categories, codes = np.unique(
+                                          values[~missing].astype(str),
+                                          return_inverse=True,
+                                          )
+
+            values = np.full(values.shape, -1, dtype=np.int32)
+            values[~missing] = codes
+            entry['categories'] = categories.tolist()
+
+        entry['file'] = 'a{}'.format(count)
+        arrays[entry['file']] = values
+        manifest['entries'].append(entry)
+
+    if compress:
+        np.savez_compressed(os.path.join(path, 'arrays.npz'), **arrays)
+    else:
+        for key, values in arrays.items():
+            np.save(
+                    os.path.join(path, key+'.npy'),
+                    values,
+                    allow_pickle=False,
+                    )
+
+    with open(os.path.join(path, manifest_name), 'w') as handle:
+        json.dump(manifest, handle)
+
+
+def load(path, mmap_mode='r'):
+    '''
+    Load what was saved with save.
+
+    inputs:
+        path = The directory that was saved.
+        mmap_mode = How to memory map uncompressed arrays (None to read).
+
+    outputs:
+        data = A DataFrame or (nested) dictionary like what was saved.
+    '''
+
+    with open(os.path.join(path, manifest_name), 'r') as handle:
+        manifest = json.load(handle)
+
+    if manifest['compress']:
+        arrays = np.load(os.path.join(path, 'arrays.npz'), allow_pickle=False)
+    else:
+        arrays = None
+
+    data = {}
+    for entry in manifest['entries']:
+
+        name = entry['name']
+        if not manifest['table']:
+            name = tuple(name)
+
+        if 'value' in entry:
+            data[name] = entry['value']
+            continue
+
+        if arrays is None:
+            values = np.load(
+                             os.path.join(path, entry['file']+'.npy'),
+                             mmap_mode=mmap_mode,
+                             allow_pickle=False,
+                             )
+            values = np.asarray(values)  # Still mapped but not a memmap
+        else:
+            values = arrays[entry['file']]
+
+        if 'categories' in entry:
+            categories = np.array(entry['categories']+[np.nan], dtype=object)
+            values = categories[values]
+
+        data[name] = values
+
+    if manifest['table']:
+        data = pd.DataFrame(data, copy=False)
+    else:
+        data = unflatten(data)
+
+    return data
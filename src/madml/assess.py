@@ -1,20 +1,257 @@
+from madml.utils import worker_pool, share, unshare
 from madml.calculators import bin_data, ground_truth
 from madml.models import assign_ground_truth
+from madml.results import cv_results
 from madml.hosting import docker
+from madml import artifacts
+from functools import partial
 from madml.plots import plotter
 from tqdm import tqdm
 
-import pandas as pd
 import numpy as np
 
 import pkg_resources
 import subprocess
+import hashlib
 import shutil
 import copy
 import dill
 import os
 
 
+def fold(
+         split,
+         model,
+         X,
+         y,
+         g,
+         n_jobs=-1,
+         pool=None,
+         save_inner_folds=None,
+         plot_options={},
+         ):
+    '''
+    Fit models and get predictions from one split.
+
+    inputs:
+        split = The train indexes, test indexes, fold count, and splitter.
+        model = The combined model to copy and fit.
+        X = The features.
+        y = The target variable.
+        g = The groups of data.
+        n_jobs = The number of cores for the inner fit.
+        pool = A worker_pool for the inner fit.
+        save_inner_folds = Top directory to save training folds.
+        plot_options = Keyword arguments for plotter (e.g. dpi).
+
+    outputs:
+        data = A dictionary of columns with predictions on the test set.
+        model = The fitted model.
+        name = The name of the splitter.
+    '''
+
+    train, test, count, name = split  # train/test
+
+    if (train.shape[0] < 1) | (test.shape[0] < 1):
+        return {}, None, name
+
+    # Fit models
+    model = copy.deepcopy(model)
+    model.pool = pool
+
+    try:
+        model.fit(
+                  X[train],
+                  y[train],
+                  g[train],
+                  n_jobs=n_jobs,
+                  )
+    except Exception:
+        return {}, None, name
+
+    # Save fold fit
+    if save_inner_folds is not None:
+        save = os.path.join(save_inner_folds, 'train_folds')
+        save = os.path.join(save, 'split_{}'.format(name))
+        save = os.path.join(save, 'fold_{}'.format(count))
+        os.makedirs(save, exist_ok=True)
+        model.plot(save, **plot_options)
+
+    # Gather predictions on test set
+    data = model.predict(X[test])
+    data = {i: data[i].to_numpy() for i in data.columns}
+
+    # Starting values
+    data['index'] = test.astype(int)
+    data['splitter'] = name
+    data['fold'] = count
+    data['y'] = y[test]
+
+    # Statistics from training data
+    mu = np.mean(y[train])
+    std = np.std(y[train])
+    mad = np.mean(np.abs(y[train]-mu))
+
+    data['std_y'] = std
+    data['mad_y'] = mad
+
+    # Predictions
+    data['r'] = y[test]-data['y_pred']
+    data['z'] = data['r']/data['y_stdc_pred']
+    data['absres'] = np.abs(data['r'])
+    data['absres/std_y'] = data['absres']/std
+    data['absres/mad_y'] = data['absres']/mad
+    data['y_stdc_pred/std_y'] = data['y_stdc_pred']/std
+
+    # Ground truths
+    data['gt_absres'] = model.gt_absres
+    data['gt_rmse'] = model.gt_rmse
+    data['gt_area'] = model.gt_area
+
+    return data, model, name
+
+
+def indexed_fold(task, *args, **kwargs):
+    '''
+    Run fold on an enumerated split so results can be reordered.
+
+    inputs:
+        task = The index and the split.
+        args = Arguments for fold.
+        kwargs = Keyword arguments for fold.
+
+    outputs:
+        index = The index of the split.
+        data = The output of fold.
+    '''
+
+    index, split = task
+
+    return index, fold(split, *args, **kwargs)
+
+
+class fold_store:
+    '''
+    On disk store of finished outer folds. Each fold is keyed by a hash of
+    the data, the splitters, the fold indexes, and the model parameters.
+    '''
+
+    def __init__(self, path, model, splitter_hash):
+        '''
+        inputs:
+            path = The directory for the store.
+            model = The unfitted combined model.
+            splitter_hash = A hash of the splitters before they were used.
+        '''
+
+        self.path = path
+        self.folds = os.path.join(path, 'folds')
+        os.makedirs(self.folds, exist_ok=True)
+
+        self.model_hash = hashlib.sha256(dill.dumps(model)).hexdigest()
+        self.splitter_hash = splitter_hash
+        self.data_hash = ''
+
+    def key(self, split):
+        '''
+        Hash a split for the current model.
+
+        inputs:
+            split = The train indexes, test indexes, fold count, and splitter.
+
+        outputs:
+            key = The hexadecimal hash.
+        '''
+
+        train, test, count, name = split
+
+        key = hashlib.sha256()
+        key.update(self.model_hash.encode())
+        key.update(self.data_hash.encode())
+        key.update(self.splitter_hash.encode())
+        key.update('{}_{}'.format(name, count).encode())
+        key.update(np.asarray(train).tobytes())
+        key.update(np.asarray(test).tobytes())
+
+        return key.hexdigest()
+
+    def dump(self, obj, path):
+        '''
+        Write a file so that a preempted job never leaves it partial.
+        '''
+
+        tmp = path+'.tmp'
+        with open(tmp, 'wb') as handle:
+            dill.dump(obj, handle)
+
+        os.replace(tmp, path)
+
+    def splits(self, splits, X, y, g):
+        '''
+        Get the splits of the first run on the same data, splitters, and
+        model. Splitters are random, so a restarted run needs the same
+        splits to find its folds. Splits of any other run are replaced.
+
+        inputs:
+            splits = The splits of the current run.
+            X = The features.
+            y = The target variable.
+            g = The groups.
+
+        outputs:
+            splits = The splits to use.
+        '''
+
+        data_hash = hashlib.sha256()
+        data_hash.update(np.asarray(X).tobytes())
+        data_hash.update(np.asarray(y).tobytes())
+        data_hash.update(np.asarray(g).astype(str).tobytes())
+        self.data_hash = data_hash.hexdigest()
+
+        config = (self.data_hash, self.splitter_hash, self.model_hash)
+
+        path = os.path.join(self.path, 'splits.dill')
+        if os.path.isfile(path):
+            with open(path, 'rb') as handle:
+                saved = dill.load(handle)
+
+            if saved.get('config') == config:
+                return saved['splits']
+
+        self.dump({'config': config, 'splits': splits}, path)
+
+        return splits
+
+    def load(self, split):
+        '''
+        Load a finished fold.
+
+        inputs:
+            split = The train indexes, test indexes, fold count, and splitter.
+
+        outputs:
+            out = The output of fold or None if the fold is missing.
+        '''
+
+        path = os.path.join(self.folds, self.key(split)+'.dill')
+        if not os.path.isfile(path):
+            return None
+
+        with open(path, 'rb') as handle:
+            return dill.load(handle)
+
+    def save(self, split, out):
+        '''
+        Save a finished fold.
+
+        inputs:
+            split = The train indexes, test indexes, fold count, and splitter.
+            out = The output of fold.
+        '''
+
+        self.dump(out, os.path.join(self.folds, self.key(split)+'.dill'))
+
+
 class nested_cv:
     '''
     Class to do nested CV.
@@ -28,6 +265,7 @@ class nested_cv:
                  g=None,
                  splitters=None,
                  n_jobs=-1,
+                 outer_jobs=1,
                  ):
 
         '''
@@ -40,11 +278,19 @@ class nested_cv:
             g = The groups of data to be split.
             splitters = All the types of splitters to assess.
             n_jobs = The number of cores to use.
+            outer_jobs = The number of outer folds to run at once (-1 for
+                         as many as n_jobs allows). The n_jobs cores are
+                         divided between outer folds and inner fits.
         '''
 
         self.X = X  # Features
         self.y = y  # Target
         self.splitters = copy.deepcopy(splitters)  # Splitter
+
+        # Splitters change when used (e.g. fitted clusters)
+        self.splitter_hash = dill.dumps(self.splitters)
+        self.splitter_hash = hashlib.sha256(self.splitter_hash).hexdigest()
+
         self.model = copy.deepcopy(model)
         self.n_jobs = n_jobs
 
@@ -74,68 +320,31 @@ class nested_cv:
             except Exception:
                 continue
 
-    def cv(self, split, save_inner_folds=None):
+        # Divide the cores between outer folds and inner fits
+        budget = os.cpu_count() if n_jobs == -1 else n_jobs
+        if outer_jobs == -1:
+            outer_jobs = len(self.splits)
+
+        self.outer_jobs = max(1, min(outer_jobs, budget))
+        self.inner_jobs = max(1, budget//self.outer_jobs)
+        self.pool = worker_pool(self.inner_jobs)  # Shared by serial fits
+
+    def cv(self, split, save_inner_folds=None, plot_options={}):
         '''
         Fit models and get predictions from one split.
         '''
 
-        train, test, count, name = split  # train/test
-
-        if (train.shape[0] < 1) | (test.shape[0] < 1):
-            return pd.DataFrame(), None, name
-
-        # Fit models
-        model = copy.deepcopy(self.model)
-
-        try:
-            model.fit(
-                      self.X[train],
-                      self.y[train],
-                      self.g[train],
-                      n_jobs=self.n_jobs,
-                      )
-        except Exception:
-            return pd.DataFrame(), None, name
-
-        # Save fold fit
-        if save_inner_folds is not None:
-            save = os.path.join(save_inner_folds, 'train_folds')
-            save = os.path.join(save, 'split_{}'.format(name))
-            save = os.path.join(save, 'fold_{}'.format(count))
-            os.makedirs(save, exist_ok=True)
-            model.plot(save)
-
-        # Gather predictions on test set
-        data = model.predict(self.X[test])
-
-        # Starting values
-        data['index'] = test.astype(int)
-        data['splitter'] = name
-        data['fold'] = count
-        data['y'] = self.y[test]
-
-        # Statistics from training data
-        mu = np.mean(self.y[train])
-        std = np.std(self.y[train])
-        mad = np.mean(np.abs(self.y[train]-mu))
-
-        data['std_y'] = std
-        data['mad_y'] = mad
-
-        # Predictions
-        data['r'] = self.y[test]-data['y_pred']
-        data['z'] = data['r']/data['y_stdc_pred']
-        data['absres'] = data['r'].abs()
-        data['absres/std_y'] = data['absres']/data['std_y']
-        data['absres/mad_y'] = data['absres']/data['mad_y']
-        data['y_stdc_pred/std_y'] = data['y_stdc_pred']/data['std_y']
-
-        # Ground truths
-        data['gt_absres'] = model.gt_absres
-        data['gt_rmse'] = model.gt_rmse
-        data['gt_area'] = model.gt_area
-
-        return data, model, name
+        return fold(
+                    split,
+                    self.model,
+                    self.X,
+                    self.y,
+                    self.g,
+                    self.inner_jobs,
+                    self.pool,
+                    save_inner_folds,
+                    plot_options,
+                    )
 
     def test(
              self,
@@ -143,6 +352,9 @@ class nested_cv:
              save_outer_folds=None,
              name=None,
              push_container=False,
+             checkpoint=None,
+             plot_options={},
+             data_format='text',
              ):
         '''
         Gather assessment data and plot results.
@@ -152,28 +364,121 @@ class nested_cv:
             save_outer_folds = The top directory to save assessment.
             name = The name of the container <account>/<repository_name>:<tag>
             push_container = Whether to build and push a container with model.
+            checkpoint = A directory to store finished outer folds. A
+                         restarted run with the same directory only fits
+                         the folds that are missing.
+            plot_options = Keyword arguments for plotter (dpi, formats,
+                           render, n_jobs) used for all plots.
+            data_format = How to save data: 'text' (CSV and JSON), 'npy'
+                          (binary files that can be memory mapped), or
+                          'npz' (compressed binary files).
 
         '''
 
-        # Assess model
-        df = []
-        count = 1
+        # Plots save data in the same format unless set otherwise
+        plot_options = {'data_format': data_format, **plot_options}
+
+        # Reuse the splits and finished folds of an interrupted run
+        if checkpoint is not None:
+            store = fold_store(checkpoint, self.model, self.splitter_hash)
+            self.splits = store.splits(
+                                       self.splits,
+                                       self.X,
+                                       self.y,
+                                       self.g,
+                                       )
+
         total = len(self.splits)
-        for i in tqdm(self.splits):
+        df = [None]*total
+        if checkpoint is not None:
+            df = [store.load(i) for i in self.splits]
+
+        pending = [i for i, j in enumerate(df) if j is None]
+        count = total-len(pending)+1
+
+        # Data is kept as columns as folds finish and only models are kept
+        results = cv_results(sum(i[1].shape[0] for i in self.splits))
+        for i in range(total):
+            if df[i] is not None:
+                results.append(df[i][0])
+                df[i] = df[i][1:]
+
+        # Assess model
+        if self.outer_jobs == 1:
+
+            for i in tqdm(pending):
+
+                with open('status.txt', 'w') as handle:
+                    print(
+                          'Starting fold {}/{}'.format(count, total),
+                          file=handle,
+                          )
+
+                data = self.cv(
+                               self.splits[i],
+                               save_inner_folds,
+                               plot_options,
+                               )
+
+                if checkpoint is not None:
+                    store.save(self.splits[i], data)
+
+                results.append(data[0])
+                df[i] = data[1:]
+
+                with open('status.txt', 'w') as handle:
+                    print(
+                          'Ending fold {}/{}'.format(count, total),
+                          file=handle,
+                          )
+
+                count += 1
+
+        elif pending:
 
             with open('status.txt', 'w') as handle:
                 print('Starting fold {}/{}'.format(count, total), file=handle)
 
-            df.append(self.cv(i, save_inner_folds))
+            # Publish data once and run outer folds on their own workers
+            shared = [share(i) for i in (self.X, self.y, self.g)]
+            pool = worker_pool(self.outer_jobs, nested=True)
+            func = partial(
+                           indexed_fold,
+                           model=self.model,
+                           X=shared[0],
+                           y=shared[1],
+                           g=shared[2],
+                           n_jobs=self.inner_jobs,
+                           save_inner_folds=save_inner_folds,
+                           plot_options=plot_options,
+                           )
 
-            with open('status.txt', 'w') as handle:
-                print('Ending fold {}/{}'.format(count, total), file=handle)
+            try:
+                tasks = [(i, self.splits[i]) for i in pending]
+                out = pool.imap_unordered(func, tasks)
+                for index, data in tqdm(out, total=len(tasks)):
 
-            count += 1
+                    if checkpoint is not None:
+                        store.save(self.splits[index], data)
 
-        models = [i[1] for i in df]
-        splitters = [i[2] for i in df]
-        df = pd.concat([i[0] for i in df])  # Combine data
+                    results.append(data[0])
+                    df[index] = data[1:]
+
+                    with open('status.txt', 'w') as handle:
+                        print(
+                              'Ending fold {}/{}'.format(count, total),
+                              file=handle,
+                              )
+
+                    count += 1
+
+            finally:
+                pool.close()
+                unshare(*shared)
+
+        models = [i[0] for i in df]
+        splitters = [i[1] for i in df]
+        df = results.to_frame()  # Combine data
 
         # Acquire ground truths
         self = ground_truth(self, self.y)
@@ -189,34 +494,32 @@ class nested_cv:
                                          )
 
         # Get domain predictions for each model on all test data
-        df_confusion = []
+        cols = [
+                'domain_absres/mad_y',
+                'domain_rmse/std_y',
+                'domain_cdf_area',
+                ]
+
+        df_confusion = cv_results(len(models)*df.shape[0])
         for i, j in zip(models, splitters):
 
             if i is None:
                 continue
 
+            d = {k: df[k].to_numpy() for k in cols}
+
             p = i.combine_domains_preds(df['d_pred'])
-            cols = p.columns
-            cols = [i.split(' (')[0] for i in cols]
-            p.columns = cols
-            d = df[[
-                    'domain_absres/mad_y',
-                    'domain_rmse/std_y',
-                    'domain_cdf_area',
-                    ]]
-
-            d = pd.concat([
-                           d.reset_index(drop=True),
-                           p.reset_index(drop=True),
-                           ], axis=1)
+            for k in p.columns:
+                d[k.split(' (')[0]] = p[k].to_numpy()
 
             d['splitter'] = j
 
             df_confusion.append(d)
 
-        df_confusion = pd.concat(df_confusion)
+        df_confusion = df_confusion.to_frame()
 
         # Full fit
+        self.model.pool = self.pool
         self.model.fit(self.X, self.y, self.g, n_jobs=self.n_jobs)
 
         # Refit on out-of-bag data for final classification models
@@ -244,30 +547,40 @@ class nested_cv:
                 os.makedirs(d, exist_ok=True)
 
             # Save model
-            np.savetxt(
-                       os.path.join(model_save, 'X.csv'),
-                       self.X,
-                       delimiter=',',
-                       )
-
-            np.savetxt(
-                       os.path.join(model_save, 'y.csv'),
-                       self.y,
-                       delimiter=',',
-                       )
-
-            np.savetxt(
-                       os.path.join(model_save, 'g.csv'),
-                       self.g,
-                       delimiter=',',
-                       fmt='%s',
-                       )
+            if data_format == 'text':
+                np.savetxt(
+                           os.path.join(model_save, 'X.csv'),
+                           self.X,
+                           delimiter=',',
+                           )
+
+                np.savetxt(
+                           os.path.join(model_save, 'y.csv'),
+                           self.y,
+                           delimiter=',',
+                           )
+
+                np.savetxt(
+                           os.path.join(model_save, 'g.csv'),
+                           self.g,
+                           delimiter=',',
+                           fmt='%s',
+                           )
+            else:
+                artifacts.save(
+                               os.path.join(model_save, 'data'),
+                               {'X': self.X, 'y': self.y, 'g': self.g},
+                               data_format == 'npz',
+                               )
 
             dill.dump(
                       self.model,
                       open(os.path.join(model_save, 'model.dill'), 'wb')
                       )
 
+            # Only what is needed to predict
+            self.model.export(os.path.join(model_save, 'model.joblib'))
+
             # Test data
             plot = plotter(
                            df,
@@ -275,6 +588,7 @@ class nested_cv:
                            df_confusion,
                            self.model.precs,
                            ass_save,
+                           **plot_options,
                            )
             plot.generate()
 
@@ -290,8 +604,8 @@ class nested_cv:
 
                 old = os.getcwd()
                 os.chdir(save)
-                shutil.copy('../model/model.dill', '.')
-                shutil.copy('../model/X.csv', '.')
+                shutil.copy('../model/model.joblib', '.')
+                np.savetxt('X.csv', self.X, delimiter=',')
 
                 # Capture current environment
                 env = subprocess.run(
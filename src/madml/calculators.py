@@ -1,57 +1,296 @@
-from sklearn.metrics import (
-                             precision_recall_curve,
-                             average_precision_score,
-                             mean_squared_error,
-                             )
-
+from sklearn.metrics import mean_squared_error
+from sklearn.cluster import estimate_bandwidth
 from scipy.optimize import minimize
-from functools import reduce
+from collections import OrderedDict
 
 import pandas as pd
 import numpy as np
 import warnings
-import copy
+import hashlib
 
-# Standard normal distribution
+# Standard normal distribution (sorted once to be a reference)
 nz = 10000
-z_standard_normal = np.random.normal(0, 1, nz)
+z_standard_normal = np.sort(np.random.normal(0, 1, nz))
+z_standard_normal_frac = np.arange(1, nz+1)/nz
 
+# Bandwidths already estimated by this process
+bandwidths = OrderedDict()
+max_bandwidths = 128
 
-def cdf(x):
+
+def cdf_sorted(x):
     '''
-    Plot the quantile quantile plot for cummulative distributions.
+    Compare the cummulative distribution of presorted data to the
+    standard normal reference.
 
     inputs:
-        x = The residuals normalized by the calibrated uncertainties.
+        x = The sorted residuals normalized by the calibrated uncertainties.
 
     outputs:
-        y = The cummulative distribution of observed data.
-        y_pred = The cummulative distribution of standard normal distribution.
+        eval_points = The union of x and the reference points.
+        y = The cummulative distribution of standard normal distribution.
+        y_pred = The cummulative distribution of observed data.
         area = The area between y and y_pred.
     '''
 
-    nx = len(x)
-
-    # Need sorting
-    x = sorted(x)
-    z = sorted(z_standard_normal)
+    z = z_standard_normal
+    nx = x.shape[0]
 
     # Cummulative fractions
-    xfrac = np.arange(1, nx+1)/(nx)
-    zfrac = np.arange(1, nz+1)/(nz)
+    xfrac = np.arange(1, nx+1)/nx
+
+    # Merge two sorted arrays and drop repeated values
+    eval_points = np.insert(z, np.searchsorted(z, x), x)
+    unique = np.ones(eval_points.shape[0], dtype=bool)
+    unique[1:] = eval_points[1:] != eval_points[:-1]
+    eval_points = eval_points[unique]
 
     # Interpolation to compare cdf
-    eval_points = sorted(list(set(x+z)))
     y_pred = np.interp(eval_points, x, xfrac)  # Predicted
-    y = np.interp(eval_points, z, zfrac)  # Standard Normal
+    y = np.interp(eval_points, z, z_standard_normal_frac)  # Standard Normal
 
     # Area between ideal distribution and observed
     absres = np.abs(y_pred-y)
-    areacdf = np.trapz(absres, x=eval_points, dx=0.00001)
+    areacdf = np.trapz(absres, x=eval_points)
 
     return eval_points, y, y_pred, areacdf
 
 
+def cdf(x):
+    '''
+    Plot the quantile quantile plot for cummulative distributions.
+
+    inputs:
+        x = The residuals normalized by the calibrated uncertainties.
+
+    outputs:
+        y = The cummulative distribution of observed data.
+        y_pred = The cummulative distribution of standard normal distribution.
+        area = The area between y and y_pred.
+    '''
+
+    x = np.sort(np.asarray(x, dtype=float))
+
+    return cdf_sorted(x)
+
+
+def cdf_area(x, groups):
+    '''
+    Compute the miscalibration area for many groups at once.
+
+    inputs:
+        x = The residuals normalized by the calibrated uncertainties.
+        groups = The group label for each value of x.
+
+    outputs:
+        labels = The unique group labels.
+        areas = The area between the observed and standard normal cdf
+                for each group in labels.
+    '''
+
+    x = np.asarray(x, dtype=float)
+    labels, codes = np.unique(groups, return_inverse=True)
+
+    # One sort for every group
+    order = np.lexsort((x, codes))
+    x = x[order]
+    bounds = np.searchsorted(codes[order], np.arange(labels.shape[0]+1))
+
+    areas = np.empty(labels.shape[0])
+    for i in range(labels.shape[0]):
+        areas[i] = cdf_sorted(x[bounds[i]:bounds[i+1]])[-1]
+
+    return labels, areas
+
+
+def prefix_metrics(y, z, max_points=200):
+    '''
+    Compute the RMSE and miscalibration area for every prefix of ordered
+    data. The RMSE is exact for every prefix. The area is exact for up to
+    max_points prefix lengths (including the first and the last) and
+    linearly interpolated between them, so the cost is bounded by
+    O(max_points*(n+nz)). The sorted prefix is kept and only new points
+    are sorted and merged into it.
+
+    inputs:
+        y = The errors in the order they are included.
+        z = The residuals normalized by the calibrated uncertainties
+            in the same order as y.
+        max_points = The most prefix lengths to find the area for exactly.
+
+    outputs:
+        rmse = The RMSE of y[:i] for every i from 1 to n.
+        area = The miscalibration area of z[:i] for every i from 1 to n.
+    '''
+
+    y = np.asarray(y, dtype=float)
+    z = np.asarray(z, dtype=float)
+    n = z.shape[0]
+
+    # Running sums give every RMSE
+    rmse = np.cumsum(y**2)/np.arange(1, n+1)
+    rmse **= 0.5
+
+    if n == 0:
+        return rmse, np.empty(0)
+
+    # Even spacing plus geometric spacing for short prefixes that change most
+    if n <= max_points:
+        sizes = np.arange(1, n+1)
+    else:
+        sizes = np.append(
+                          np.linspace(1, n, max(1, max_points//2)),
+                          np.geomspace(1, n, max(1, max_points//2)),
+                          )
+        sizes = np.unique(np.round(sizes).astype(int))
+
+    # Merge the points added since the last size into the sorted buffer
+    areas = np.empty(sizes.shape[0])
+    x = np.empty(0)
+    start = 0
+    for count, stop in enumerate(sizes):
+        new = np.sort(z[start:stop])
+        x = np.insert(x, np.searchsorted(x, new, side='right'), new)
+        start = stop
+
+        areas[count] = cdf_sorted(x)[-1]
+
+    area = np.interp(np.arange(1, n+1), sizes, areas)
+
+    return rmse, area
+
+
+def welford(values):
+    '''
+    One pass mean and sum of squared deviations over a stream of arrays.
+
+    inputs:
+        values = An iterable of equally shaped arrays.
+
+    outputs:
+        count = The number of arrays.
+        mean = The element wise mean.
+        m2 = The element wise sum of squared deviations from the mean.
+    '''
+
+    count = 0
+    mean = 0.0
+    m2 = 0.0
+    for x in values:
+        count += 1
+        delta = x-mean
+        mean = mean+delta/count
+        m2 = m2+delta*(x-mean)
+
+    return count, mean, m2
+
+
+def merge_welford(a, b):
+    '''
+    Merge two results of welford from separate streams.
+
+    inputs:
+        a = The count, mean, and m2 of the first stream.
+        b = The count, mean, and m2 of the second stream.
+
+    outputs:
+        count = The number of arrays.
+        mean = The element wise mean.
+        m2 = The element wise sum of squared deviations from the mean.
+    '''
+
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+
+    if count_a == 0:
+        return b
+    if count_b == 0:
+        return a
+
+    count = count_a+count_b
+    delta = mean_b-mean_a
+    mean = mean_a+delta*count_b/count
+    m2 = m2_a+m2_b+delta**2*count_a*count_b/count
+
+    return count, mean, m2
+
+
+def fingerprint(X):
+    '''
+    Identify data by its content.
+
+    inputs:
+        X = The data.
+
+    outputs:
+        key = A hash of the shape, type, and values of X.
+    '''
+
+    X = np.ascontiguousarray(X)
+
+    key = hashlib.sha256(str((X.shape, X.dtype.str)).encode())
+    key.update(X.view(np.uint8).data if X.size else b'')
+
+    return key.hexdigest()
+
+
+def bandwidth(X, method='estimate', n_samples=None, quantile=0.3):
+    '''
+    Get a kernel bandwidth for data. Results are cached by the content
+    of X so refitting on the same data does not repeat the estimate.
+
+    inputs:
+        X = The features.
+        method = 'estimate' for the mean distance to nearest neighbors
+                 within a quantile (quadratic cost), or the closed form
+                 'scott' or 'silverman' rules (linear cost).
+        n_samples = For 'estimate', the number of random cases to use
+                    (None for all cases).
+        quantile = For 'estimate', the fraction of neighbors to use.
+
+    outputs:
+        h = The bandwidth.
+    '''
+
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1:
+        X = X.reshape(-1, 1)
+
+    key = (fingerprint(X), method, n_samples, quantile)
+    if key in bandwidths:
+        bandwidths.move_to_end(key)
+        return bandwidths[key]
+
+    n, m = X.shape
+    if method == 'estimate':
+        h = estimate_bandwidth(
+                               X,
+                               quantile=quantile,
+                               n_samples=n_samples,
+                               random_state=0,
+                               )
+
+    elif method in ['scott', 'silverman']:
+
+        if method == 'scott':
+            factor = n**(-1/(m+4))
+        else:
+            factor = (n*(m+2)/4)**(-1/(m+4))
+
+        # Isotropic kernels use the typical spread of the features
+        h = factor*np.sqrt(np.mean(np.var(X, axis=0, ddof=1)))
+
+    else:
+        raise ValueError('Unknown bandwidth method: {}'.format(method))
+
+    h = float(h)
+    bandwidths[key] = h
+    if len(bandwidths) > max_bandwidths:
+        bandwidths.popitem(last=False)
+
+    return h
+
+
 def llh(std, res, x, func):
     '''
     Compute the log likelihood.
@@ -66,15 +305,51 @@ def llh(std, res, x, func):
         total =  The total negative log likelihood.
     '''
 
+    var = func(x, std)**2
+
     total = np.log(2*np.pi)
-    total += np.log(func(x, std)**2)
-    total += (res**2)/(func(x, std)**2)
+    total += np.log(var)
+    total += (res**2)/var
     total *= -0.5
 
     return total
 
 
-def set_llh(y, y_pred, y_std, x, func):
+def poly_nll(c, powers, res2, weights=None):
+    '''
+    The mean negative log likelihood of residuals for poly and its
+    gradient with respect to the coefficients.
+
+    inputs:
+        c = The polynomial coefficients.
+        powers = The UQ measure raised to each power of c (n by len(c)).
+        res2 = The squared residuals.
+        weights = The weight of each residual summing to one (None for
+                  equal weights).
+
+    outputs:
+        nll = The mean negative log likelihood.
+        grad = The gradient of nll.
+    '''
+
+    if weights is None:
+        weights = np.full(res2.shape[0], 1/res2.shape[0])
+
+    p = powers@c
+    std = np.abs(p)
+    var = std**2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nll = 0.5*weights@(np.log(2*np.pi*var)+res2/var)
+
+        # d/dc_k of 0.5*(log(s^2)+r^2/s^2) with s = |p|
+        w = (var-res2)/(var*std)*np.sign(p)
+        grad = powers.T@(weights*w)
+
+    return nll, grad
+
+
+def set_llh(y, y_pred, y_std, x, func, weights=None):
     '''
     Compute the log likelihood for a dataset.
 
@@ -84,22 +359,67 @@ def set_llh(y, y_pred, y_std, x, func):
         y_std = The uncertainty of the target variable.
         x = The initial guess for UQ fitting parameters.
         func = The UQ fitting function.
+        weights = The weight of each case (None for equal weights).
 
     outputs
         params = The fit parameters for the UQ function.
     '''
 
-    res = y-y_pred
+    res = np.asarray(y-y_pred, dtype=float)
+    y_std = np.asarray(y_std, dtype=float)
+    x = np.asarray(x, dtype=float)
+
+    if weights is None:
+        weights = np.ones(res.shape[0])
+
+    weights = np.asarray(weights, dtype=float)
+    weights = weights/weights.sum()
 
     # Get negative to use minimization instead of maximization of llh
     with warnings.catch_warnings():
         warnings.simplefilter('ignore')
 
-        opt = minimize(
-                       lambda x: -sum(llh(y_std, res, x, func))/len(res),
-                       x,
-                       method='nelder-mead',
-                       )
+        if func is not poly:
+            opt = minimize(
+                           lambda x: -weights@llh(y_std, res, x, func),
+                           x,
+                           method='nelder-mead',
+                           )
+
+            return opt.x
+
+        # Gradient based fits from a few starts for polynomials
+        powers = np.vander(y_std, x.shape[0], increasing=True)
+        res2 = res**2
+
+        starts = [x]
+
+        # Least squares fit of the expected absolute residual
+        root = weights**0.5
+        fit = np.linalg.lstsq(
+                              powers*root[:, None],
+                              np.abs(res)*root*(np.pi/2)**0.5,
+                              rcond=None,
+                              )
+        starts.append(fit[0])
+
+        # The initial guess scaled to the size of the residuals
+        scale = (weights@res2)/(weights@(powers@x)**2)
+        if np.isfinite(scale) and (scale > 0):
+            starts.append(x*scale**0.5)
+
+        opt = None
+        for start in starts:
+            i = minimize(
+                         poly_nll,
+                         start,
+                         args=(powers, res2, weights),
+                         jac=True,
+                         method='L-BFGS-B',
+                         )
+
+            if (opt is None) or (i.fun < opt.fun):
+                opt = i
 
     params = opt.x
 
@@ -118,49 +438,92 @@ def poly(c, std):
         total = The aggregate absolute value result from the polynomial.
     '''
 
-    total = 0.0
-    for i in range(len(c)):
-        total += c[i]*std**i
-    total = abs(total)
+    # Horner's scheme with the highest power first
+    total = np.abs(np.polyval(np.asarray(c)[::-1], std))
 
     return total
 
 
-def pr(d, labels, precs):
+def pr_curve(d, labels):
+    '''
+    Precision recall curve from cumulative counts of ID cases. This gives
+    the same curve as sklearn with ID as the positive class and -d as the
+    score.
+
+    inputs:
+        d = The dissimilarity scores sorted from lowest to highest.
+        labels = True for ID cases in the same order as d.
+
+    outputs:
+        precision = The precisions from the highest threshold down.
+        recall = The recalls in the same order as precision.
+        thresholds = The thresholds on d in the same order as precision
+                     without the last point.
+        auc_score = The average precision.
+    '''
+
+    # The last case at each distinct score
+    ends = np.append(np.flatnonzero(np.diff(d)), d.shape[0]-1)
+
+    tps = np.cumsum(labels)[ends]
+    fps = 1+ends-tps
+
+    precision = tps/(tps+fps)
+    recall = tps/tps[-1]
+
+    precision = np.append(precision[::-1], 1.0)
+    recall = np.append(recall[::-1], 0.0)
+    thresholds = d[ends][::-1]
+
+    auc_score = -np.sum(np.diff(recall)*precision[:-1])
+
+    return precision, recall, thresholds, auc_score
+
+
+def pr(d, labels, precs, presorted=False):
     '''
     Precision recall curve.
+
+    inputs:
+        d = The dissimilarity scores.
+        labels = The domain labels as 'ID'/'OD' or booleans true for ID.
+        precs = The minimum precisions to find thresholds for.
+        presorted = Whether d is already sorted from lowest to highest.
+
+    outputs:
+        data = The thresholds and the precision recall curve.
     '''
 
+    d = np.asarray(d, dtype=float)
+    labels = np.asarray(labels)
+    if labels.dtype != bool:
+        labels = labels == 'ID'
+
+    n_id = np.count_nonzero(labels)
+
     # Compensate for all classes being ID/OD
-    if all(i == 'ID' for i in labels):
+    if n_id == labels.shape[0]:
         precision = np.array([1.0, 1.0])
         recall = np.array([0.0, 1.0])
         thresholds = np.repeat(np.inf, 2)
         auc_score = 1.0
 
-    elif all(i == 'OD' for i in labels):
+    elif n_id == 0:
         precision = np.array([0.0, 0.0])
         recall = np.array([0.0, 1.0])
         thresholds = np.array([-np.inf])
         auc_score = 0.0
 
     else:
-        d = -d  # Because lowest d is more likely ID
-        prc_scores = precision_recall_curve(
-                                            labels,
-                                            d,
-                                            pos_label='ID',
-                                            )
 
-        precision, recall, thresholds = prc_scores
+        # Lowest d is more likely ID
+        if not presorted:
+            order = np.argsort(d, kind='stable')
+            d = d[order]
+            labels = labels[order]
 
-        auc_score = average_precision_score(
-                                            labels,
-                                            d,
-                                            pos_label='ID',
-                                            )+0.0  # Make positive
-
-        thresholds *= -1
+        precision, recall, thresholds, auc_score = pr_curve(d, labels)
+        auc_score += 0.0  # Make positive
 
     num = 2*recall*precision
     den = recall+precision
@@ -182,17 +545,14 @@ def pr(d, labels, precs):
                       'F1': f1_scores[max_f1_index],
                       }
 
-    # Loop for lowest to highest to get better thresholds
+    # The first index reaching a precision is found on the running maximum
     nprec = len(precision)
     nthresh = nprec-1  # sklearn convention
-    nthreshindex = nthresh-1  # Foor loop index comparison
-    loop = range(nprec)
-    for cut in precs:
-
-        for index in loop:
-            p = precision[index]
-            if p >= cut:
-                break
+    nthreshindex = nthresh-1  # Index comparison
+    running = np.maximum.accumulate(precision)
+    indexes = np.searchsorted(running, precs, side='left')
+    indexes = np.minimum(indexes, nprec-1)  # Last point when never reached
+    for cut, index in zip(precs, indexes):
 
         name = 'Minimum Precision: {}'.format(cut)
         data[name] = {
@@ -208,7 +568,7 @@ def pr(d, labels, precs):
             data[name]['Threshold'] = thresholds[index]
 
     data['AUC'] = auc_score
-    data['Baseline'] = np.sum(labels == 'ID')/labels.shape[0]
+    data['Baseline'] = n_id/labels.shape[0]
     data['AUC-Baseline'] = (auc_score-data['Baseline'])+0.0  # Force positive
     data['Precision'] = precision.tolist()
     data['Recall'] = recall.tolist()
@@ -218,63 +578,75 @@ def pr(d, labels, precs):
 
 
 def bin_data(data_cv, bins, by='d_pred'):
+    '''
+    Bin data by quantiles and get statistics for each bin.
+
+    inputs:
+        data_cv = The CV data.
+        bins = The number of bins to get.
+        by = The column to bin by.
+
+    outputs:
+        data_cv = A shuffled copy of the data with bins assigned.
+        bin_cv = The statistics for each bin.
+    '''
 
-    # Copy to prevent problems
-    data_cv = copy.deepcopy(data_cv)
     data_cv = data_cv.sample(frac=1)  # Shuffle to prevent sorting bias
 
+    x = data_cv[by].to_numpy(dtype=float)
+    x_sorted = np.sort(x[~np.isnan(x)])
+
     # Correct for cases were many cases are at the same value
-    count = 0
-    unique_quantiles = 0
     max_iters = 100
-    while unique_quantiles < bins:
-        quantiles = pd.qcut(
-                            data_cv[by],
-                            bins+count,
-                            duplicates='drop',
-                            )
-        unique_quantiles = len(quantiles.unique())
-
-        if count >= max_iters:
-            break
+    for count in range(max_iters+1):
+        edges = np.quantile(x_sorted, np.linspace(0, 1, bins+count+1))
+        edges = np.unique(edges)
 
-        count += 1
+        # One bin when every value is the same
+        if edges.shape[0] < 2:
+            edges = np.append(edges, np.nextafter(edges[0], np.inf))
+
+        # Bins are closed on the right with the lowest value included
+        counts = np.diff(np.searchsorted(x_sorted, edges, side='right'))
+        counts[0] += np.searchsorted(x_sorted, edges[0], side='right')
+
+        if np.count_nonzero(counts) >= bins:
+            break
 
-    data_cv['bin'] = quantiles
-
-    # Calculate statistics
-    bin_groups = data_cv.groupby('bin', observed=False, sort=False)
-    distmean = bin_groups['d_pred'].mean()
-    binmax = bin_groups['d_pred'].max()
-    counts = bin_groups['z'].count()
-    stdc = bin_groups['y_stdc_pred/std_y'].mean()
-    rmse = bin_groups['absres/std_y'].apply(lambda x: (sum(x**2)/len(x))**0.5)
-
-    area = bin_groups.apply(lambda x: cdf(
-                                          x['z'],
-                                          )[-1])
-
-    area = area.to_frame().rename({0: 'cdf_area'}, axis=1)
-
-    distmean = distmean.to_frame().add_suffix('_mean')
-    binmax = binmax.to_frame().add_suffix('_max')
-    stdc = stdc.to_frame().add_suffix('_mean')
-    rmse = rmse.to_frame().rename({'absres/std_y': 'rmse/std_y'}, axis=1)
-    counts = counts.to_frame().rename({'z': 'count'}, axis=1)
-
-    # Combine data for each bin
-    bin_cv = [
-              counts,
-              distmean,
-              binmax,
-              stdc,
-              rmse,
-              area,
-              ]
-
-    bin_cv = reduce(lambda x, y: pd.merge(x, y, on='bin'), bin_cv)
-
-    bin_cv = bin_cv.reset_index()
+    # Same intervals as pd.qcut
+    data_cv['bin'] = pd.cut(data_cv[by], edges, include_lowest=True)
+    codes = data_cv['bin'].cat.codes.to_numpy()
+    n = data_cv['bin'].cat.categories.shape[0]
+
+    d = data_cv['d_pred'].to_numpy(dtype=float)
+    stdc = data_cv['y_stdc_pred/std_y'].to_numpy(dtype=float)
+    absres = data_cv['absres/std_y'].to_numpy(dtype=float)
+    z = data_cv['z'].to_numpy(dtype=float)
+
+    # Cases outside of bins (missing values) are not counted
+    valid = codes >= 0
+    codes, d, stdc, absres, z = [i[valid] for i in (codes, d, stdc, absres, z)]
+
+    # Statistics for each bin from one sort
+    order = np.argsort(codes, kind='stable')
+    observed, starts = np.unique(codes[order], return_index=True)
+    counts = np.bincount(codes, minlength=n)[observed]
+
+    def mean(values):
+        return np.bincount(codes, values, minlength=n)[observed]/counts
+
+    labels = pd.Categorical.from_codes(observed, dtype=data_cv['bin'].dtype)
+    _, area = cdf_area(z, codes)
+
+    bin_cv = pd.DataFrame({
+                           'bin': labels,
+                           'count': counts,
+                           'd_pred_mean': mean(d),
+                           'd_pred_max': np.maximum.reduceat(d[order], starts),
+                           'y_stdc_pred/std_y_mean': mean(stdc),
+                           'rmse/std_y': mean(absres**2)**0.5,
+                           'cdf_area': area,
+                           })
 
     return data_cv, bin_cv
 
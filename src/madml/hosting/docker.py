@@ -1,5 +1,7 @@
 import pandas as pd
 import subprocess
+import tempfile
+import shutil
 import docker
 import os
 
@@ -43,22 +45,26 @@ class dockerhub_model:
             container_name = The name with the tag for the container to run.
         '''
 
+        # A directory for each call so callers do not share files
+        path = tempfile.mkdtemp(dir=os.getcwd())
+
         df = pd.DataFrame(df)
-        df.to_csv('./test.csv', index=False)
+        df.to_csv(os.path.join(path, 'test.csv'), index=False)
 
         command = 'udocker --allow-root run -v '
-        command += '{}:/mnt '.format(os.getcwd())
+        command += '{}:/mnt '.format(path)
         command += self.container
         command += ' python3 model_predict.py'
 
-        subprocess.check_output(
-                                command,
-                                shell=True
-                                )
+        try:
+            subprocess.check_output(
+                                    command,
+                                    shell=True
+                                    )
 
-        df = pd.read_csv('./prediction.csv')
+            df = pd.read_csv(os.path.join(path, 'prediction.csv'))
 
-        os.remove('./test.csv')
-        os.remove('./prediction.csv')
+        finally:
+            shutil.rmtree(path)
 
         return df
@@ -0,0 +1,381 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from madml.models import load_model
+from urllib.parse import urlparse
+
+import pandas as pd
+import numpy as np
+
+import http.client
+import threading
+import argparse
+import queue
+import time
+import dill
+import io
+
+
+def dumps_array(X):
+    '''
+    Encode features as .npy bytes.
+
+    inputs:
+        X = The features.
+
+    outputs:
+        data = The bytes.
+    '''
+
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(X), allow_pickle=False)
+
+    return buffer.getvalue()
+
+
+def loads_array(data):
+    '''
+    Decode .npy bytes without unpickling anything.
+
+    inputs:
+        data = The bytes.
+
+    outputs:
+        X = The features.
+    '''
+
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+def dumps_frame(df):
+    '''
+    Encode predictions as .npz bytes with text as fixed width strings.
+
+    inputs:
+        df = The predictions.
+
+    outputs:
+        data = The bytes.
+    '''
+
+    arrays = {'columns': np.array(df.columns, dtype=str)}
+    for count, key in enumerate(df.columns):
+        values = df[key].to_numpy()
+        if values.dtype.kind == 'O':
+            values = values.astype(str)
+
+        arrays['c{}'.format(count)] = values
+
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+
+    return buffer.getvalue()
+
+
+def loads_frame(data):
+    '''
+    Decode predictions from dumps_frame.
+
+    inputs:
+        data = The bytes.
+
+    outputs:
+        df = The predictions.
+    '''
+
+    arrays = np.load(io.BytesIO(data), allow_pickle=False)
+    columns = arrays['columns']
+
+    df = {j: arrays['c{}'.format(i)] for i, j in enumerate(columns)}
+    df = pd.DataFrame(df)
+
+    return df
+
+
+class handler(BaseHTTPRequestHandler):
+    '''
+    Answer POST /predict with the predictions for an .npy body.
+    '''
+
+    protocol_version = 'HTTP/1.1'  # Keep connections open
+    disable_nagle_algorithm = True  # Do not delay small replies
+
+    def do_POST(self):
+
+        if self.path != '/predict':
+            self.reply(404, b'Unknown path')
+            return
+
+        try:
+            size = int(self.headers['Content-Length'])
+            X = loads_array(self.rfile.read(size))
+            data = dumps_frame(self.server.model_server.predict(X))
+
+        except Exception as error:
+            self.reply(500, str(error).encode())
+            return
+
+        self.reply(200, data)
+
+    def reply(self, code, data):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class model_server:
+    '''
+    A local prediction service. The model is loaded once and kept in
+    memory, and requests that arrive together are predicted as one batch.
+    '''
+
+    def __init__(
+                 self,
+                 model,
+                 host='127.0.0.1',
+                 port=0,
+                 max_batch=10000,
+                 max_wait=0.005,
+                 ):
+        '''
+        inputs:
+            model = A fitted model or the path to one saved with
+                    combine.export (.joblib) or dill.
+            host = The address to listen on.
+            port = The port to listen on (0 for any free port).
+            max_batch = The most cases to predict at once.
+            max_wait = The seconds to wait for more requests to batch.
+        '''
+
+        if isinstance(model, str) and model.endswith('.joblib'):
+            model = load_model(model)
+
+        elif isinstance(model, str):
+            with open(model, 'rb') as handle:
+                model = dill.load(handle)
+
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.model_server = self
+
+        host, port = self.httpd.server_address[:2]
+        self.url = 'http://{}:{}'.format(host, port)
+
+        self.threads = []
+
+    def start(self):
+        '''
+        Start serving in background threads.
+
+        outputs:
+            self = The running server.
+        '''
+
+        self.threads = [
+                        threading.Thread(target=self.batch, daemon=True),
+                        threading.Thread(
+                                         target=self.httpd.serve_forever,
+                                         daemon=True,
+                                         ),
+                        ]
+
+        for i in self.threads:
+            i.start()
+
+        return self
+
+    def close(self):
+        '''
+        Stop serving.
+        '''
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.requests.put(None)  # Stop batching
+
+        for i in self.threads:
+            i.join()
+
+        self.threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def predict(self, X):
+        '''
+        Queue features for the next batch and wait for predictions.
+
+        inputs:
+            X = The features.
+
+        outputs:
+            df = The predictions.
+        '''
+
+        request = {'X': X, 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+
+        if 'error' in request:
+            raise request['error']
+
+        return request['df']
+
+    def batch(self):
+        '''
+        Predict queued requests together until stopped.
+        '''
+
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+
+            # Gather what arrives soon after the first request
+            batch = [request]
+            size = request['X'].shape[0]
+            end = time.monotonic()+self.max_wait
+            while size < self.max_batch:
+                try:
+                    timeout = max(0.0, end-time.monotonic())
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                if request is None:
+                    self.requests.put(None)
+                    break
+
+                batch.append(request)
+                size += request['X'].shape[0]
+
+            try:
+                X = np.concatenate([i['X'] for i in batch])
+                df = self.model.predict(X)
+
+                start = 0
+                for i in batch:
+                    stop = start+i['X'].shape[0]
+                    i['df'] = df.iloc[start:stop].reset_index(drop=True)
+                    start = stop
+
+            # One bad request should not fail the others
+            except Exception:
+                for i in batch:
+                    try:
+                        i['df'] = self.model.predict(i['X'])
+                    except Exception as error:
+                        i['error'] = error
+
+            for i in batch:
+                i['done'].set()
+
+
+class model_client:
+    '''
+    A client for model_server that keeps its connection open and sends
+    binary data.
+    '''
+
+    def __init__(self, url, timeout=None):
+        '''
+        inputs:
+            url = The address of the server (e.g. http://127.0.0.1:8000).
+            timeout = The seconds to wait for the server.
+        '''
+
+        url = urlparse(url)
+        self.host = url.hostname
+        self.port = url.port
+        self.timeout = timeout
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def request(self, body):
+        '''
+        Send features and get the reply.
+
+        inputs:
+            body = The encoded features.
+
+        outputs:
+            response = The status and body from the server.
+        '''
+
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(
+                                                         self.host,
+                                                         self.port,
+                                                         timeout=self.timeout,
+                                                         )
+
+        headers = {'Content-Type': 'application/octet-stream'}
+        self.connection.request('POST', '/predict', body, headers)
+        response = self.connection.getresponse()
+
+        return response.status, response.read()
+
+    def predict(self, X):
+        '''
+        Get predictions from the server.
+
+        inputs:
+            X = The features.
+
+        outputs:
+            df = The predictions.
+        '''
+
+        body = dumps_array(X)
+
+        with self.lock:
+            try:
+                status, data = self.request(body)
+
+            # Reconnect once if the server closed the connection
+            except (http.client.HTTPException, ConnectionError):
+                self.close()
+                status, data = self.request(body)
+
+        if status != 200:
+            raise RuntimeError(data.decode())
+
+        return loads_frame(data)
+
+    def close(self):
+        '''
+        Close the connection.
+        '''
+
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serve a madml model.')
+    parser.add_argument('model', help='A .joblib export or dill file.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    server = model_server(args.model, args.host, args.port)
+    print('Serving on {}'.format(server.url))
+    server.start()
+
+    try:
+        server.threads[1].join()
+    except KeyboardInterrupt:
+        server.close()
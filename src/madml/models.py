@@ -2,29 +2,41 @@ from sklearn.gaussian_process.kernels import (
                                               ConstantKernel,
                                               WhiteKernel,
                                               Matern,
+                                              Sum,
                                               )
 from madml.calculators import (
+                               merge_welford,
                                ground_truth,
                                bin_data,
+                               bandwidth,
+                               welford,
                                set_llh,
                                poly,
                                pr,
                                )
 
+from madml.utils import parallel, worker_pool, share, unshare
+from scipy.linalg import cholesky, cho_solve, solve_triangular
 from sklearn.gaussian_process import GaussianProcessRegressor
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.ensemble import ExtraTreesRegressor
 from sklearn.model_selection import RepeatedKFold
-from sklearn.cluster import estimate_bandwidth
+from sklearn.neighbors import NearestNeighbors
 from sklearn.neighbors import KernelDensity
 from scipy.spatial.distance import cdist
-from madml.utils import parallel
+from madml.results import cv_results
 from madml.plots import plotter
 from sklearn.base import clone
+from functools import reduce
 
 import pandas as pd
 import numpy as np
 
 import warnings
+import joblib
 import copy
+import os
 
 pd.options.mode.chained_assignment = None
 
@@ -39,17 +51,25 @@ class calibration:
                  uq_func=poly,
                  params=None,
                  prior=None,
+                 max_buffer=2000,
+                 forget=None,
                  ):
         '''
         inputs:
             uq_func = The type of UQ function.
             params = The fitting coefficients initial guess.
             prior = A prior function fit to predict values.
+            max_buffer = For partial_fit, the most (merged) cases kept.
+            forget = For partial_fit, the factor each older case's weight
+                     is multiplied by per new case (None to never forget).
         '''
 
         self.params = params
         self.uq_func = uq_func
         self.prior = prior
+        self.max_buffer = max_buffer
+        self.forget = forget
+        self.buffer = None
 
     def fit(self, y, y_pred, y_std):
         '''
@@ -69,9 +89,102 @@ class calibration:
                                   self.params,
                                   self.uq_func
                                   )
+
+            # Start partial_fit from these cases
+            self.buffer = None
+            self.update(y, y_pred, y_std)
+
         elif self.prior is None:
             self.uq_func.fit(y_std.reshape(-1, 1), abs(y-y_pred))
 
+    def update(self, y, y_pred, y_std):
+        '''
+        Add cases to the buffer used by partial_fit. Each case is kept as
+        the UQ measure, the squared residual, and a weight. Once the buffer
+        is full, cases with similar UQ measures are merged. The likelihood
+        only depends on the mean squared residual at each UQ measure, so
+        merging is exact for equal UQ measures.
+
+        inputs:
+            y = The target variable.
+            y_pred = The prediction for the target variable.
+            y_std = The uncertainty for the target variable.
+        '''
+
+        y_std = np.asarray(y_std, dtype=float)
+        res2 = np.asarray(y-y_pred, dtype=float)**2
+        n = y_std.shape[0]
+
+        # The newest case has a weight of one
+        if self.forget is None:
+            weights = np.ones(n)
+        else:
+            weights = self.forget**np.arange(n-1, -1, -1, dtype=float)
+
+        new = np.column_stack([y_std, res2, weights])
+        if self.buffer is not None:
+            old = self.buffer.copy()
+            if self.forget is not None:
+                old[:, 2] *= self.forget**n
+
+            new = np.concatenate([old, new])
+
+        # Drop cases that were forgotten
+        new = new[new[:, 2] > np.finfo(float).tiny]
+
+        if new.shape[0] > self.max_buffer:
+
+            # Merge into groups with similar UQ measures
+            size = max(self.max_buffer//2, 1)
+            edges = np.quantile(new[:, 0], np.linspace(0, 1, size+1)[1:-1])
+            groups = np.searchsorted(edges, new[:, 0])
+            groups = np.unique(groups, return_inverse=True)[1]
+
+            weights = np.bincount(groups, new[:, 2])
+            merged = np.empty((weights.shape[0], 3))
+            for i in range(2):
+                merged[:, i] = np.bincount(groups, new[:, 2]*new[:, i])
+                merged[:, i] /= weights
+
+            merged[:, 2] = weights
+            new = merged
+
+        self.buffer = new
+
+    def partial_fit(self, y, y_pred, y_std):
+        '''
+        Update the UQ parameters with new cases without refitting from
+        scratch. The fit starts from the current parameters and uses the
+        cases from fit and earlier partial_fit calls kept in a bounded
+        buffer, with older cases weighted down if forget is set.
+
+        inputs:
+            y = The target variable.
+            y_pred = The prediction for the target variable.
+            y_std = The uncertainty for the target variable.
+        '''
+
+        if self.prior is not None:
+            return
+
+        if self.params is None:
+            if not hasattr(self.uq_func, 'partial_fit'):
+                raise ValueError('UQ function has no partial_fit.')
+
+            self.uq_func.partial_fit(y_std.reshape(-1, 1), abs(y-y_pred))
+            return
+
+        self.update(y, y_pred, y_std)
+
+        self.params = set_llh(
+                              self.buffer[:, 1]**0.5,
+                              0.0,
+                              self.buffer[:, 0],
+                              self.params,
+                              self.uq_func,
+                              self.buffer[:, 2],
+                              )
+
     def predict(self, y_std):
         '''
         Use the fitted UQ model to predict uncertainties.
@@ -100,13 +213,47 @@ class dissimilarity:
                  dis='kde',
                  kernel=None,
                  bandwidth=None,
+                 n_samples=None,
                  scale=True,
+                 n_neighbors=None,
+                 n_inducing=None,
+                 n_restarts=10,
+                 n_jobs=None,
+                 warm_start=False,
                  ):
+        '''
+        inputs:
+            dis = The dissimilarity ('kde', 'gpr', or a distance metric).
+            kernel = The kernel for 'kde' or 'gpr'.
+            bandwidth = The bandwidth for 'kde' or 'gpr' or how to get it
+                        from the training data ('estimate', 'scott', or
+                        'silverman'). None is 'estimate'.
+            n_samples = For an 'estimate' bandwidth, the number of
+                        random training cases to use (None for all).
+            scale = Whether to scale dissimilarities with training data.
+            n_neighbors = For a distance metric, use the mean distance to
+                          this many nearest training cases from a tree
+                          index instead of the mean to all training cases.
+            n_inducing = For 'gpr', approximate the Gaussian process with
+                         this many inducing points (None for exact).
+            n_restarts = The number of 'gpr' hyperparameter restarts.
+            n_jobs = The number of threads for 'gpr' restarts.
+            warm_start = For 'gpr', start from the kernel of the last fit
+                         without restarts. Copies of a fitted model then
+                         reuse its hyperparameters.
+        '''
 
         self.dis = dis
         self.kernel = kernel
         self.bandwidth = bandwidth
+        self.n_samples = n_samples
         self.scale = scale
+        self.n_neighbors = n_neighbors
+        self.n_inducing = n_inducing
+        self.n_restarts = n_restarts
+        self.n_jobs = n_jobs
+        self.warm_start = warm_start
+        self.kernel_ = None  # The fitted 'gpr' kernel
 
     def fit(
             self,
@@ -128,7 +275,14 @@ class dissimilarity:
         '''
 
         if self.bandwidth is None:
-            self.bandwidth = estimate_bandwidth(X_train)
+            method = 'estimate'
+        elif isinstance(self.bandwidth, str):
+            method = self.bandwidth
+        else:
+            method = None
+
+        if (method is not None) and (self.dis in ['kde', 'gpr']):
+            self.bandwidth = bandwidth(X_train, method, self.n_samples)
 
         if (self.kernel is None) and self.dis == 'kde':
             self.kernel = 'epanechnikov'
@@ -138,78 +292,108 @@ class dissimilarity:
             self.kernel *= Matern(self.bandwidth)
             self.kernel += WhiteKernel(self.bandwidth)
 
+        # Fitted models and normalization constants are kept as attributes
+        self.norm = None
         if self.dis == 'kde':
 
             if self.bandwidth > 0.0:
-                model = KernelDensity(
-                                      kernel=self.kernel,
-                                      bandwidth=self.bandwidth,
-                                      )
-
-                model.fit(X_train)
-
-                dis = model.score_samples(X_train)
-                m = np.max(dis)
-
-                def pred(X):
-                    out = model.score_samples(X)
-
-                    if self.scale:
-                        out = out-m
+                self.model = KernelDensity(
+                                           kernel=self.kernel,
+                                           bandwidth=self.bandwidth,
+                                           )
 
-                    out = np.exp(out)
-                    out = 1-out
-                    out = np.maximum(0.0, out)
-                    return out
+                self.model.fit(X_train)
 
-                self.model = pred
+                if self.scale:
+                    self.norm = np.max(self.model.score_samples(X_train))
 
             else:
-                self.model = lambda x: np.repeat(1.0, len(x))
+                self.model = None
 
         elif self.dis == 'gpr':
 
             if self.bandwidth <= 0.0:
                 self.bandwidth = 1e-4  # Just a small number
 
-            model = GaussianProcessRegressor(
-                                             kernel=self.kernel,
-                                             n_restarts_optimizer=10,
-                                             )
+            if self.warm_start and (self.kernel_ is not None):
+                kernel = self.kernel_
+                n_restarts = 0
+            else:
+                kernel = self.kernel
+                n_restarts = self.n_restarts
 
             with warnings.catch_warnings():
                 warnings.simplefilter('ignore')
 
-                model.fit(X_train, y_train)
-                _, dis = model.predict(X_train, return_std=True)
-                m = np.max(dis)
-
-            def pred(X):
-                _, out = model.predict(X, return_std=True)
-
-                if self.scale:
-                    out = out/m
-                    out = out/(out+1)
+                if self.n_inducing is None:
+                    self.model = fit_gpr(
+                                         kernel,
+                                         X_train,
+                                         y_train,
+                                         n_restarts,
+                                         self.n_jobs,
+                                         )
+                else:
+                    self.model = sparse_gpr(
+                                            kernel,
+                                            self.n_inducing,
+                                            n_restarts,
+                                            self.n_jobs,
+                                            )
+                    self.model.fit(X_train, y_train)
+
+                self.kernel_ = self.model.kernel_
+
+                _, dis = self.model.predict(X_train, return_std=True)
+                self.norm = np.max(dis)
+
+        elif self.n_neighbors is not None:
+
+            self.model = NearestNeighbors(
+                                          n_neighbors=min(
+                                                          self.n_neighbors,
+                                                          X_train.shape[0],
+                                                          ),
+                                          metric=self.dis,
+                                          )
+            self.model.fit(X_train)
+
+            if self.scale:
+                self.norm = 0.0
+
+                # Leave each case out of its own neighbors
+                n_neighbors = min(self.n_neighbors, X_train.shape[0]-1)
+                if n_neighbors > 0:
+                    dis, _ = self.model.kneighbors(n_neighbors=n_neighbors)
+                    self.norm = np.max(np.mean(dis, axis=1))
+
+                # No scaling when training cases are all the same
+                if not self.norm > 0:
+                    self.norm = 1.0
 
-                return out
+        else:
 
-            self.model = pred
+            self.model = X_train
 
-        else:
+            if self.scale:
+                dis = mean_distance(X_train, X_train, self.dis)
+                self.norm = np.max(dis)
 
-            def pred(X):
-                out = cdist(X_train, X, self.dis)
-                out = np.mean(out, axis=0)
+    def warm_copy(self):
+        '''
+        Get an unfitted copy that keeps the estimates from this fit
+        (bandwidth, kernels, and the fitted 'gpr' kernel).
 
-                if self.scale:
-                    dis = np.mean(cdist(X_train, X_train), axis=0)
-                    m = np.max(dis)
-                    out = out/m
-                    out = out/(out+1)
+        outputs:
+            model = The copy that starts from this fit.
+        '''
 
-                return out
+        model = copy.copy(self)
+        model.model = None
+        model.norm = None
+        model.warm_start = True
 
-            self.model = pred
+        return model
 
     def predict(self, X):
         '''
@@ -221,11 +405,210 @@ class dissimilarity:
             d = The Dissimilarites.
         '''
 
-        d = self.model(X)
+        if self.dis == 'kde':
+
+            if self.model is None:
+                return np.repeat(1.0, len(X))
+
+            d = self.model.score_samples(X)
+
+            if self.scale:
+                d = d-self.norm
+
+            d = np.exp(d)
+            d = 1-d
+            d = np.maximum(0.0, d)
+
+            return d
+
+        if self.dis == 'gpr':
+            _, d = self.model.predict(X, return_std=True)
+
+        elif self.n_neighbors is not None:
+            d, _ = self.model.kneighbors(X)
+            d = np.mean(d, axis=1)
+
+        else:
+            d = mean_distance(self.model, X, self.dis)
+
+        if self.scale:
+            d = d/self.norm
+            d = d/(d+1)
 
         return d
 
 
+def fit_gpr(kernel, X, y, n_restarts=10, n_jobs=None):
+    '''
+    Fit a Gaussian process where optimizer restarts run on threads.
+    Restarts begin from log-uniform draws within the kernel bounds like
+    the restarts in scikit-learn.
+
+    inputs:
+        kernel = The initial kernel.
+        X = The features.
+        y = The target variable.
+        n_restarts = The number of extra starting points.
+        n_jobs = The number of threads (None for serial).
+
+    outputs:
+        model = The Gaussian process with the best log marginal likelihood.
+    '''
+
+    thetas = [kernel.theta]
+    if kernel.n_dims > 0:
+        bounds = kernel.bounds
+        for i in range(n_restarts):
+            thetas.append(np.random.uniform(bounds[:, 0], bounds[:, 1]))
+
+    def fit(theta):
+        model = GaussianProcessRegressor(
+                                         kernel=kernel.clone_with_theta(theta),
+                                         n_restarts_optimizer=0,
+                                         )
+        model.fit(X, y)
+
+        return model
+
+    if (n_jobs is None) or (n_jobs == 1) or (len(thetas) == 1):
+        models = [fit(i) for i in thetas]
+    else:
+        n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        with ThreadPoolExecutor(min(n_jobs, len(thetas))) as pool:
+            models = list(pool.map(fit, thetas))
+
+    model = max(models, key=lambda i: i.log_marginal_likelihood_value_)
+
+    return model
+
+
+class sparse_gpr:
+    '''
+    Gaussian process with the deterministic training conditional
+    approximation. Hyperparameters are fit on a random subset of training
+    cases that also serve as inducing points. The cost is then linear in
+    the number of training cases.
+    '''
+
+    def __init__(self, kernel, n_inducing=100, n_restarts=10, n_jobs=None):
+        '''
+        inputs:
+            kernel = The initial kernel.
+            n_inducing = The number of inducing points.
+            n_restarts = The number of hyperparameter restarts.
+            n_jobs = The number of threads for restarts.
+        '''
+
+        self.kernel = kernel
+        self.n_inducing = n_inducing
+        self.n_restarts = n_restarts
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y, block=10000):
+        '''
+        Fit the approximation.
+
+        inputs:
+            X = The features.
+            y = The target variable.
+            block = The number of training cases handled at once.
+        '''
+
+        n = X.shape[0]
+        indx = np.random.choice(n, min(self.n_inducing, n), replace=False)
+        self.Z = X[indx]
+
+        gpr = fit_gpr(
+                      self.kernel,
+                      self.Z,
+                      y[indx],
+                      self.n_restarts,
+                      self.n_jobs,
+                      )
+        self.kernel_ = gpr.kernel_
+
+        # Separate the noise level from the signal kernel
+        white = isinstance(self.kernel_, Sum)
+        white = white and isinstance(self.kernel_.k2, WhiteKernel)
+        if white:
+            self.signal = self.kernel_.k1
+            self.noise = self.kernel_.k2.noise_level
+        else:
+            self.signal = self.kernel_
+            self.noise = gpr.alpha
+
+        m = self.Z.shape[0]
+        kmm = self.signal(self.Z)+1e-8*np.eye(m)
+        self.lm = cholesky(kmm, lower=True)
+
+        # Accumulate products over blocks of training cases
+        aat = np.zeros((m, m))
+        ay = np.zeros(m)
+        for i in range(0, n, block):
+            a = solve_triangular(
+                                 self.lm,
+                                 self.signal(self.Z, X[i:i+block]),
+                                 lower=True,
+                                 )
+            aat += a @ a.T
+            ay += a @ y[i:i+block]
+
+        self.lb = cholesky(np.eye(m)+aat/self.noise, lower=True)
+        self.alpha = cho_solve((self.lb, True), ay)/self.noise
+
+        return self
+
+    def predict(self, X, return_std=False):
+        '''
+        Predict with the approximation.
+
+        inputs:
+            X = The features.
+            return_std = Whether to return the predictive standard deviation.
+
+        outputs:
+            mean = The predictive mean.
+            std = The predictive standard deviation.
+        '''
+
+        a = solve_triangular(self.lm, self.signal(self.Z, X), lower=True)
+        mean = a.T @ self.alpha
+
+        if not return_std:
+            return mean
+
+        c = solve_triangular(self.lb, a, lower=True)
+        var = self.signal.diag(X)-np.sum(a**2, axis=0)+np.sum(c**2, axis=0)
+        var += self.noise
+        std = np.maximum(var, 0.0)**0.5
+
+        return mean, std
+
+
+def mean_distance(X_train, X, metric, max_size=2**22):
+    '''
+    Get the mean distance from each case to all training cases in blocks
+    so that the full distance matrix is never stored.
+
+    inputs:
+        X_train = The features of the training set.
+        X = The features of data.
+        metric = The distance metric for cdist.
+        max_size = The maximum number of distances held at once.
+
+    outputs:
+        d = The mean distances.
+    '''
+
+    block = max(1, max_size//max(1, X_train.shape[0]))
+
+    d = np.empty(X.shape[0])
+    for i in range(0, X.shape[0], block):
+        d[i:i+block] = np.mean(cdist(X_train, X[i:i+block], metric), axis=0)
+
+    return d
+
+
 class domain:
     '''
     Domain classification model.
@@ -238,17 +621,65 @@ class domain:
     def fit(self, d, labels):
         '''
         Train the domain model on dissimilarity scores by finding thresholds.
+        The scores are kept sorted so that partial_fit can add to them.
+        '''
+
+        d = np.asarray(d, dtype=float)
+        labels = domain_mask(labels)
+
+        order = np.argsort(d, kind='stable')
+        self.scores = d[order]
+        self.labels = labels[order]
+        self.pending = []
+
+        self.data = pr(self.scores, self.labels, self.precs, presorted=True)
+
+    def partial_fit(self, d, labels):
+        '''
+        Add observations without refitting. Thresholds are updated by
+        refit, which predict calls when there are new observations.
+
+        inputs:
+            d = The dissimilarity scores.
+            labels = The domain labels as 'ID'/'OD' or booleans true for ID.
         '''
 
-        self.data = pr(d, labels, self.precs)
+        d = np.asarray(d, dtype=float).ravel()
+        self.pending.append((d, domain_mask(labels).ravel()))
+
+    def refit(self):
+        '''
+        Merge observations from partial_fit into the sorted scores and
+        update the thresholds. Only the new observations are sorted.
+        '''
+
+        if not self.pending:
+            return
+
+        d = np.concatenate([i[0] for i in self.pending])
+        labels = np.concatenate([i[1] for i in self.pending])
+        self.pending = []
+
+        order = np.argsort(d, kind='stable')
+        d = d[order]
+        labels = labels[order]
+
+        index = np.searchsorted(self.scores, d, side='right')
+        self.scores = np.insert(self.scores, index, d)
+        self.labels = np.insert(self.labels, index, labels)
+
+        self.data = pr(self.scores, self.labels, self.precs, presorted=True)
 
-    def predict(self, d, d_input=None):
+    def predict(self, d, d_input=None, output='label'):
         '''
         Predict the domain based on thresholds.
 
         inputs:
             d = The score.
             d_input = A user defined cutoff on d.
+            output = The type of prediction. Use 'label' for 'ID'/'OD'
+                     strings, 'bool' for true when ID, or 'category' for
+                     a categorical of 'ID'/'OD'.
 
         outputs:
             do_pred = The domain prediction.
@@ -264,7 +695,12 @@ class domain:
                 'AUC-Baseline',
                 ]
 
-        do_pred = pd.DataFrame()
+        if self.pending:
+            self.refit()
+
+        d = np.asarray(d)
+
+        do_pred = {}
         for key, value in self.data.items():
 
             if key in skip:
@@ -276,14 +712,61 @@ class domain:
 
             key = 'Domain Prediction from {} (p={},r={})'.format(key, p, r)
             cut = value['Threshold']
-            do_pred[key] = np.where(d < cut, 'ID', 'OD')
+            do_pred[key] = domain_labels(d < cut, output)
 
         if d_input is not None:
-            do_pred['d_input'] = np.where(d <= d_input, 'ID', 'OD')
+            do_pred['d_input'] = domain_labels(d <= d_input, output)
+
+        do_pred = pd.DataFrame(do_pred)
 
         return do_pred
 
 
+def domain_mask(labels):
+    '''
+    Convert domain labels to a mask of in domain cases.
+
+    inputs:
+        labels = The domain labels as 'ID'/'OD' or booleans true for ID.
+
+    outputs:
+        mask = True where a case is ID.
+    '''
+
+    labels = np.asarray(labels)
+    if labels.dtype != bool:
+        labels = labels == 'ID'
+
+    return labels
+
+
+def domain_labels(mask, output='label'):
+    '''
+    Convert a mask of in domain cases to domain predictions.
+
+    inputs:
+        mask = True where a case is ID.
+        output = 'label', 'bool', or 'category'.
+
+    outputs:
+        labels = The domain predictions.
+    '''
+
+    if output == 'label':
+        labels = np.where(mask, 'ID', 'OD')
+    elif output == 'bool':
+        labels = mask
+    elif output == 'category':
+        labels = pd.Categorical.from_codes(
+                                           (~mask).astype(np.int8),
+                                           categories=['ID', 'OD'],
+                                           )
+    else:
+        raise ValueError('Unsupported output: {}'.format(output))
+
+    return labels
+
+
 def pipe_transforms(model, X):
     '''
     Apply all steps from a pipeline before the final prediction.
@@ -303,50 +786,125 @@ def pipe_transforms(model, X):
     return X
 
 
-def predict_std(model, X):
+def ensemble_members(ensemble, X):
+    '''
+    Get a function predicting with one member of an ensemble. Forests
+    validate the input once and skip validation in every tree. Bagging
+    members only see the features they were trained on.
+
+    inputs:
+        ensemble = The fitted ensemble model.
+        X = The features.
+
+    outputs:
+        member = A function of the estimator index giving its predictions.
+    '''
+
+    estimators = ensemble.estimators_
+
+    if isinstance(ensemble, (RandomForestRegressor, ExtraTreesRegressor)):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+
+        def member(i):
+            return estimators[i].predict(X, check_input=False)
+
+    elif hasattr(ensemble, 'estimators_features_'):
+        features = ensemble.estimators_features_
+        n_features = X.shape[1]
+
+        def member(i):
+            f = features[i]
+            if (f.shape[0] == n_features) and np.all(f[1:] > f[:-1]):
+                return estimators[i].predict(X)
+            else:
+                return estimators[i].predict(X[:, f])
+
+    else:
+
+        def member(i):
+            return estimators[i].predict(X)
+
+    return member
+
+
+def predict_std(model, X, n_jobs=None):
     '''
     Get predictions from ensemble model.
 
     inputs:
         model = The gridsearch pipeline model.
         X = The featues.
+        n_jobs = The number of threads over estimators (None for serial).
 
     outputs:
         std = The standard deviation between models from ensemble model.
     '''
 
-    estimators = model.best_estimator_
-    estimators = estimators.named_steps['model']
-    estimators = estimators.estimators_
+    ensemble = model.best_estimator_
+    ensemble = ensemble.named_steps['model']
+    member = ensemble_members(ensemble, X)
+
+    n = len(ensemble.estimators_)
+    if (n_jobs is None) or (n_jobs == 1):
+        groups = [range(n)]
+    else:
+        n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        groups = np.array_split(np.arange(n), min(n_jobs, n))
 
-    std = []
-    for i in estimators:
-        std.append(i.predict(X))
+    # Each group keeps running moments instead of every prediction
+    def moments(group):
+        return welford(np.ravel(member(i)) for i in group)
 
-    std = np.std(std, axis=0)
+    if len(groups) == 1:
+        out = [moments(groups[0])]
+    else:
+        with ThreadPoolExecutor(len(groups)) as pool:
+            out = list(pool.map(moments, groups))
+
+    count, _, m2 = reduce(merge_welford, out)
+    std = (m2/count)**0.5
 
     return std
 
 
 def assign_ground_truth(data_cv, bin_cv):
+    '''
+    Label cases and bins as in or out of domain by their ground truths.
+    Bin statistics and labels are added to the frames in place.
 
-    data_cv = copy.deepcopy(data_cv)
-    bin_cv = copy.deepcopy(bin_cv)
+    inputs:
+        data_cv = The binned CV data with ground truth columns.
+        bin_cv = The statistics for each bin.
 
-    data_cv = data_cv.merge(bin_cv, on=['bin'])
+    outputs:
+        data_cv = The CV data with bin statistics and labels.
+        bin_cv = The bin statistics with ground truths and labels.
+    '''
 
-    # Innitiate arrays
-    cols = ['gt_absres', 'gt_rmse', 'gt_area']
-    for c in cols:
-        bin_cv[c] = None
+    # Cases without a bin have no statistics
+    categories = data_cv['bin'].cat.categories
+    codes = data_cv['bin'].cat.codes.to_numpy()
+    if (codes < 0).any():
+        data_cv = data_cv[codes >= 0]
+        codes = codes[codes >= 0]
 
-    # Propagate ground truths
-    for group, value in data_cv.groupby(['bin', *cols], observed=True):
-        row = bin_cv['bin'] == group[0]
+    data_cv.index = pd.RangeIndex(data_cv.shape[0])
+
+    # The row of bin_cv for each case
+    rows = pd.Categorical(bin_cv['bin'], categories=categories).codes
+    index = np.full(categories.shape[0], -1)
+    index[rows] = np.arange(rows.shape[0])
+    index = index[codes]
+
+    for c in bin_cv.columns.drop('bin'):
+        data_cv[c] = bin_cv[c].to_numpy()[index]
 
-        bin_cv.loc[row, 'gt_absres'] = group[1]
-        bin_cv.loc[row, 'gt_rmse'] = group[2]
-        bin_cv.loc[row, 'gt_area'] = group[3]
+    # Propagate ground truths
+    cols = ['gt_absres', 'gt_rmse', 'gt_area']
+    for c in cols:
+        values = np.full(bin_cv.shape[0], np.nan)
+        values[index] = data_cv[c].to_numpy(dtype=float)
+        bin_cv[c] = values
 
     # Make labels
     absres = data_cv['absres/mad_y'] < data_cv['gt_absres']
@@ -384,6 +942,7 @@ class combine:
                  gt_rmse=None,
                  gt_area=None,
                  disable_tqdm=False,
+                 warm_start=False,
                  ):
 
         '''
@@ -397,6 +956,12 @@ class combine:
             gt_absres = The ground truth for absoulte residuals.
             gt_rmse = The ground truth for rmse.
             gt_area = The ground truth for miscalibration area.
+            disable_tqdm = Whether to disable the progress bar.
+            warm_start = Fit on all data before the splits and reuse its
+                         best grid parameters and dissimilarity estimates
+                         (e.g. bandwidth) in every split. This is faster,
+                         but splits no longer choose hyperparameters
+                         without their test data.
         '''
 
         self.gs_model = gs_model
@@ -409,6 +974,8 @@ class combine:
         self.splits = copy.deepcopy(splits)
         self.precs = precs
         self.disable_tqdm = disable_tqdm
+        self.warm_start = warm_start
+        self.pool = None  # Workers kept between fits
 
         # Add a splitter to calibrate UQ and prevent overfitting
         uqsplits = []
@@ -420,7 +987,8 @@ class combine:
 
         self.splits += uqsplits
 
-    def cv(self, split, gs_model, ds_model, X, y, g=None):
+    @staticmethod
+    def cv(split, gs_model, ds_model, X, y, g=None, best_params=None):
         '''
         Do cross validation.
 
@@ -431,22 +999,32 @@ class combine:
             X = The features.
             y = The target variable.
             g = The groups for data.
-            split = The split of data.
+            best_params = Grid parameters to use instead of searching.
 
         outputs:
-            data = A pandas dataframe containing CV results.
+            data = A dictionary of columns containing CV results.
         '''
 
         count, splitter, tr, te = split
 
         if (tr.shape[0] < 1) | (te.shape[0] < 1):
-            return pd.DataFrame()
+            return {}
 
         # Copy/clone models to prefent leakage
         ds_model_cv = copy.deepcopy(ds_model)
         gs_model_cv = clone(gs_model)
 
-        gs_model_cv.fit(X[tr], y[tr])
+        if best_params is None:
+            gs_model_cv.fit(X[tr], y[tr])
+
+        else:
+
+            # Fit the known best pipeline without a search
+            best = clone(gs_model.estimator).set_params(**best_params)
+            best.fit(X[tr], y[tr])
+
+            gs_model_cv.best_params_ = best_params
+            gs_model_cv.best_estimator_ = best
 
         # Get scaled features
         X_trans_tr = pipe_transforms(gs_model_cv, X[tr])
@@ -455,7 +1033,7 @@ class combine:
         ds_model_cv.fit(X_trans_tr, y[tr])
 
         # Variable to save data
-        data = pd.DataFrame()
+        data = {}
 
         # Starting values
         data['index'] = te.astype(int)
@@ -476,12 +1054,34 @@ class combine:
         data['y_stdu_pred'] = predict_std(gs_model_cv, X_trans_te)
         data['d_pred'] = ds_model_cv.predict(X_trans_te)
         data['r'] = y[te]-data['y_pred']
-        data['absres'] = data['r'].abs()
-        data['absres/std_y'] = data['absres']/data['std_y']
-        data['absres/mad_y'] = data['absres']/data['mad_y']
+        data['absres'] = np.abs(data['r'])
+        data['absres/std_y'] = data['absres']/std
+        data['absres/mad_y'] = data['absres']/mad
 
         return data
 
+    def split(self, X, y, g=None):
+        '''
+        Generate the splits of every splitter one at a time. A splitter
+        that fails (e.g. one needing groups without them) is skipped.
+
+        inputs:
+            X = The features.
+            y = The target variable.
+            g = The groups.
+
+        outputs:
+            split = The fold count, splitter name, and train and test
+                    indexes for each split.
+        '''
+
+        for i in self.splits:
+            try:
+                for count, (tr, te) in enumerate(i[1].split(X, y, g), 1):
+                    yield count, i[0], tr, te
+            except Exception:
+                continue
+
     def fit(self, X, y, g=None, d_input=None, n_jobs=-1):
         '''
         Fit all models. Thresholds for domain classification are also set.
@@ -498,51 +1098,83 @@ class combine:
             data_cv_bin = The binned cross validation data.
         '''
 
-        # Generate all splits
-        splits = []
-        for i in self.splits:
-            try:
-                for count, (tr, te) in enumerate(i[1].split(X, y, g), 1):
-                    splits.append((count, i[0], tr, te))
-            except Exception:
-                continue
+        # Splits are made as they are needed
+        splits = self.split(X, y, g)
+
+        # Unfitted models for each split
+        gs_model = clone(self.gs_model)
+        ds_model = self.ds_model
+        best_params = None
+
+        # Fit on all data first and share what was found with each split
+        if self.warm_start:
+            self.gs_model.fit(X, y)
+            self.ds_model.fit(pipe_transforms(self.gs_model, X), y)
+
+            best_params = self.gs_model.best_params_
+            if hasattr(self.ds_model, 'warm_copy'):
+                ds_model = self.ds_model.warm_copy()
 
         # Analyze each split
+        data_cv = cv_results()
         if n_jobs == 1:
-            data_cv = []
             for i in splits:
                 d = self.cv(
                             i,
-                            gs_model=self.gs_model,
-                            ds_model=self.ds_model,
+                            gs_model=gs_model,
+                            ds_model=ds_model,
                             X=X,
                             y=y,
                             g=g,
+                            best_params=best_params,
                             )
 
                 data_cv.append(d)
 
         else:
-            data_cv = parallel(
+
+            if n_jobs == -1:
+                n_jobs = os.cpu_count()
+
+            # Replace a pool of another size instead of running both
+            if (self.pool is None) or (self.pool.n_jobs != n_jobs):
+                if self.pool is not None:
+                    self.pool.close()
+
+                self.pool = worker_pool(n_jobs)
+
+            # Publish data once instead of pickling for every split
+            shared = [share(i) for i in (X, y, g)]
+
+            try:
+                out = parallel(
                                self.cv,
                                splits,
                                disable=self.disable_tqdm,
-                               gs_model=self.gs_model,
-                               ds_model=self.ds_model,
-                               X=X,
-                               y=y,
-                               g=g,
+                               pool=self.pool,
+                               gs_model=gs_model,
+                               ds_model=ds_model,
+                               X=shared[0],
+                               y=shared[1],
+                               g=shared[2],
+                               best_params=best_params,
                                )
+            finally:
+                unshare(*shared)
+
+            for d in out:
+                data_cv.append(d)
 
         # Put data in one dataframe
-        data_cv = pd.concat(data_cv)
+        data_cv = data_cv.to_frame()
 
         # Separate data
         data_id = data_cv[data_cv['splitter'] == 'calibration']
         data_cv = data_cv[data_cv['splitter'] != 'calibration']
 
         # Fit models
-        self.gs_model.fit(X, y)
+        if not self.warm_start:
+            self.gs_model.fit(X, y)
 
         self.uq_model.fit(
                           data_id['y'].values,
@@ -550,12 +1182,13 @@ class combine:
                           data_id['y_stdu_pred'].values
                           )
 
-        X_trans = pipe_transforms(
-                                  self.gs_model,
-                                  X,
-                                  )
+        if not self.warm_start:
+            X_trans = pipe_transforms(
+                                      self.gs_model,
+                                      X,
+                                      )
 
-        self.ds_model.fit(X_trans, y)
+            self.ds_model.fit(X_trans, y)
 
         # Update data not used for calibration of UQ
         data_cv['y_stdc_pred'] = self.uq_model.predict(data_cv['y_stdu_pred'])
@@ -605,55 +1238,155 @@ class combine:
         self.data_cv = data_cv
         self.bin_cv = bin_cv
 
-    def combine_domains_preds(self, d, d_input=None):
+    def combine_domains_preds(self, d, d_input=None, output='label'):
         '''
         Combine domain classifiers that were fit for RMSE
         and miscalibration area.
-        '''
 
-        # Predict domains on training data
-        data_absres_dom_pred = self.domain_absres.predict(d, d_input)
-        data_absres_dom_pred = data_absres_dom_pred.add_prefix('absres/mad_y ')
+        inputs:
+            d = The dissimilarity scores.
+            d_input = The d cutoff to use that is custom from user.
+            output = The type of domain prediction (see domain.predict).
+        '''
 
-        data_rmse_dom_pred = self.domain_rmse.predict(d, d_input)
-        data_rmse_dom_pred = data_rmse_dom_pred.add_prefix('rmse/std_y ')
+        domains = [
+                   ('absres/mad_y ', self.domain_absres),
+                   ('rmse/std_y ', self.domain_rmse),
+                   ('cdf_area ', self.domain_area),
+                   ]
 
-        data_area_dom_pred = self.domain_area.predict(d, d_input)
-        data_area_dom_pred = data_area_dom_pred.add_prefix('cdf_area ')
+        # Predict domains on training data
+        dom_pred = {}
+        for prefix, model in domains:
+            for key, value in model.predict(d, d_input, output).items():
+                dom_pred[prefix+key] = value.values
 
-        dom_pred = pd.concat([
-                              data_absres_dom_pred,
-                              data_rmse_dom_pred,
-                              data_area_dom_pred,
-                              ], axis=1)
+        dom_pred = pd.DataFrame(dom_pred)
 
         return dom_pred
 
-    def predict(self, X, d_input=None):
+    def predict(
+                self,
+                X,
+                d_input=None,
+                output='label',
+                n_jobs=None,
+                ):
         '''
         Aggregate all predictions from models.
+
+        inputs:
+            X = The features.
+            d_input = The d cutoff to use that is custom from user.
+            output = The type of domain prediction (see domain.predict).
+            n_jobs = The number of threads over ensemble estimators.
         '''
 
         # Transform data
         X_trans = pipe_transforms(self.gs_model, X)
 
         # Predict from each model
-        pred = pd.DataFrame()
+        pred = {}
         pred['y_pred'] = self.gs_model.predict(X)
         pred['d_pred'] = self.ds_model.predict(X_trans)
-        pred['y_stdu_pred'] = predict_std(self.gs_model, X_trans)
+        pred['y_stdu_pred'] = predict_std(self.gs_model, X_trans, n_jobs)
         pred['y_stdc_pred'] = self.uq_model.predict(pred['y_stdu_pred'])
+        pred = pd.DataFrame(pred)
 
         pred = pd.concat([
                           pred,
-                          self.combine_domains_preds(pred['d_pred'], d_input),
+                          self.combine_domains_preds(
+                                                     pred['d_pred'],
+                                                     d_input,
+                                                     output,
+                                                     ),
                           ], axis=1)
 
         return pred
 
-    def plot(self, save):
+    def predict_batches(
+                        self,
+                        X_iter,
+                        chunk_size=10000,
+                        d_input=None,
+                        output='label',
+                        n_jobs=None,
+                        ):
+        '''
+        Predict chunk by chunk so that memory stays bounded.
+
+        inputs:
+            X_iter = The features or an iterable of feature blocks
+                     (e.g. pandas.read_csv with chunksize).
+            chunk_size = The maximum number of cases to predict at once.
+            d_input = The d cutoff to use that is custom from user.
+            output = The type of domain prediction (see domain.predict).
+            n_jobs = The number of threads over ensemble estimators.
+
+        outputs:
+            A generator of prediction frames indexed by case.
+        '''
+
+        if hasattr(X_iter, 'shape'):
+            X_iter = [X_iter]
+
+        start = 0
+        for X in X_iter:
+
+            X = np.asarray(X)
+            for i in range(0, X.shape[0], chunk_size):
+
+                pred = self.predict(
+                                    X[i:i+chunk_size],
+                                    d_input,
+                                    output,
+                                    n_jobs,
+                                    )
+                pred.index += start
+                start += pred.shape[0]
+
+                yield pred
+
+    def export(self, path):
+        '''
+        Save only what is needed to predict. CV data, bin data, grid
+        search results, and precision-recall curves are left out and
+        arrays are stored so they can be memory mapped by load_model. The
+        sorted scores of domain models are kept for partial_fit.
+        Functions given for UQ must be importable to be saved.
+
+        inputs:
+            path = The file to save.
+        '''
+
+        model = copy.copy(self)
+        model.data_cv = None
+        model.bin_cv = None
+        model.pool = None
+
+        model.gs_model = copy.copy(self.gs_model)
+        if hasattr(model.gs_model, 'cv_results_'):
+            del model.gs_model.cv_results_
+
+        # Keep thresholds but not curves
+        for name in ['domain_absres', 'domain_rmse', 'domain_area']:
+            dom = copy.copy(getattr(self, name))
+            dom.data = {
+                        i: j for i, j in dom.data.items()
+                        if i not in ['Precision', 'Recall', 'Thresholds']
+                        }
+
+            setattr(model, name, dom)
+
+        joblib.dump(model, path)
+
+    def plot(self, save, **kwargs):
         '''
         Plot model fit data.
+
+        inputs:
+            save = The location to save plots.
+            kwargs = Options for plotter (dpi, formats, render, n_jobs).
         '''
 
         plot = plotter(
@@ -661,5 +1394,21 @@ class combine:
                        self.bin_cv,
                        precs=self.precs,
                        save=save,
+                       **kwargs,
                        )
         plot.generate()
+
+
+def load_model(path, mmap_mode='r'):
+    '''
+    Load a model saved with combine.export.
+
+    inputs:
+        path = The saved file.
+        mmap_mode = How to memory map arrays (None to read them).
+
+    outputs:
+        model = The model.
+    '''
+
+    return joblib.load(path, mmap_mode=mmap_mode)
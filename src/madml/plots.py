@@ -4,9 +4,11 @@ from sklearn.metrics import (
                              ConfusionMatrixDisplay,
                              )
 
+from madml.utils import worker_pool
 from matplotlib import pyplot as pl
-from madml.utils import parallel
 from madml import calculators
+from madml import artifacts
+from functools import partial
 from sklearn import metrics
 
 import numpy as np
@@ -18,58 +20,106 @@ import os
 font = {'font.size': 16, 'lines.markersize': 10}
 matplotlib.rcParams.update(font)
 
+# How figures are written by plot_dump
+settings = {
+            'dpi': 400,
+            'formats': ['png'],
+            'render': True,
+            'data_format': 'text',
+            }
+
 
 def plot_dump(data, fig, ax, name, save, suffix, legend=True):
     '''
     Function to dump figures.
 
     inputs:
-        data = Data to dump in json file.
+        data = Data to dump in json file (or binary artifacts).
         fig = Figure object.
         ax = Axes object.
         name = The name for the plot.
         save = The location to save plot.
         suffix = Append a suffix to the save name.
+
+    Figures are written in each of the formats in settings, or not at all
+    (only data) when rendering is off.
     '''
 
-    fig.tight_layout()
+    if settings['render']:
 
-    if legend:
+        fig.tight_layout()
 
-        fig_legend, ax_legend = pl.subplots()
-        ax_legend.axis(False)
+        if legend:
 
-        legend = ax_legend.legend(
-                                  *ax.get_legend_handles_labels(),
-                                  frameon=False,
-                                  loc='center',
-                                  bbox_to_anchor=(0.5, 0.5)
-                                  )
+            fig_legend, ax_legend = pl.subplots()
+            ax_legend.axis(False)
 
-        ax_legend.spines['top'].set_visible(False)
-        ax_legend.spines['bottom'].set_visible(False)
-        ax_legend.spines['left'].set_visible(False)
-        ax_legend.spines['right'].set_visible(False)
+            legend = ax_legend.legend(
+                                      *ax.get_legend_handles_labels(),
+                                      frameon=False,
+                                      loc='center',
+                                      bbox_to_anchor=(0.5, 0.5)
+                                      )
 
-        fig_legend.savefig(os.path.join(
-                                        save,
-                                        '{}_{}_legend.png'.format(name, suffix)
-                                        ), bbox_inches='tight', dpi=400)
+            ax_legend.spines['top'].set_visible(False)
+            ax_legend.spines['bottom'].set_visible(False)
+            ax_legend.spines['left'].set_visible(False)
+            ax_legend.spines['right'].set_visible(False)
 
-        ax.legend([]).set_visible(False)
+            for i in settings['formats']:
+                name_legend = '{}_{}_legend.{}'.format(name, suffix, i)
+                fig_legend.savefig(
+                                   os.path.join(save, name_legend),
+                                   bbox_inches='tight',
+                                   dpi=settings['dpi'],
+                                   )
 
-        pl.close(fig_legend)
+            ax.legend([]).set_visible(False)
 
-    fig.savefig(os.path.join(
-                             save,
-                             '{}_{}.png'.format(name, suffix)
-                             ), bbox_inches='tight', dpi=400)
+            pl.close(fig_legend)
+
+        for i in settings['formats']:
+            fig.savefig(
+                        os.path.join(save, '{}_{}.{}'.format(name, suffix, i)),
+                        bbox_inches='tight',
+                        dpi=settings['dpi'],
+                        )
 
     pl.close(fig)
 
-    jsonfile = os.path.join(save, '{}_{}.json'.format(name, suffix))
-    with open(jsonfile, 'w') as handle:
-        json.dump(data, handle)
+    if settings['data_format'] == 'text':
+        jsonfile = os.path.join(save, '{}_{}.json'.format(name, suffix))
+        with open(jsonfile, 'w') as handle:
+            json.dump(data, handle)
+    else:
+        artifacts.save(
+                       os.path.join(save, '{}_{}'.format(name, suffix)),
+                       data,
+                       settings['data_format'] == 'npz',
+                       )
+
+
+def render(job, options, backend=None):
+    '''
+    Run one plotting function with the given plot_dump settings.
+
+    inputs:
+        job = The plotting function and its arguments.
+        options = The settings for plot_dump.
+        backend = The matplotlib backend to use (e.g. 'Agg' in workers).
+    '''
+
+    if backend is not None:
+        pl.switch_backend(backend)
+
+    old = settings.copy()
+    settings.update(options)
+
+    try:
+        func, args = job
+        func(*args)
+    finally:
+        settings.update(old)
 
 
 def confidence(df, save='.', suffix='all'):
@@ -82,17 +132,6 @@ def confidence(df, save='.', suffix='all'):
         suffix = Append a suffix to the save name.
     '''
 
-    def func(i, d, y, z):
-
-        removed = d[i-1]
-        y_sub = y[:i]
-        z_sub = z[:i]
-
-        rmse = (sum(y_sub**2)/y_sub.shape[0])**0.5
-        area = calculators.cdf(z_sub)[-1]
-
-        return removed, rmse, area
-
     def sub(x, y, ylabel, key, gt, gtlabel, auc, metric, color):
 
         if key == r'$|y-\hat{y}|$':
@@ -158,18 +197,10 @@ def confidence(df, save='.', suffix='all'):
         y = df['absres/std_y'].values[indx]
         z = df['z'].values[indx]
 
-        out = parallel(
-                       func,
-                       loop,
-                       d=d,
-                       y=y,
-                       z=z,
-                       disable=True,
-                       )
-
-        remo = [i[0] for i in out]
-        rmse = [i[1] for i in out]
-        area = [i[2] for i in out]
+        rmse, area = calculators.prefix_metrics(y, z)
+        remo = d.tolist()
+        rmse = rmse.tolist()
+        area = area.tolist()
 
         auc_rmse = np.trapz(rmse, x=frac, dx=0.00001)
         auc_area = np.trapz(area, x=frac, dx=0.00001)
@@ -695,9 +726,35 @@ class plotter:
                  df_confusion=None,
                  precs=None,
                  save='.',
+                 dpi=400,
+                 formats=['png'],
+                 render=True,
+                 n_jobs=1,
+                 data_format='text',
                  ):
+        '''
+        inputs:
+            df = The CV data.
+            df_bin = The binned CV data.
+            df_confusion = Domain predictions from each model.
+            precs = The precisions used for domain thresholds.
+            save = The location to save plots.
+            dpi = The resolution of raster figures.
+            formats = The file formats of figures (e.g. 'png' or 'svg').
+            render = Whether to draw figures or only save their data.
+            n_jobs = The number of processes drawing figures.
+            data_format = How to save data: 'text' (CSV and JSON), 'npy'
+                          (binary files that can be memory mapped), or
+                          'npz' (compressed binary files). Binary runs can
+                          be plotted again with load_plotter.
+        '''
 
         self.save = save
+        self.dpi = dpi
+        self.formats = formats
+        self.render = render
+        self.n_jobs = n_jobs
+        self.data_format = data_format
         self.errors = ['absres/mad_y', 'rmse/std_y', 'cdf_area']
         self.domains = ['domain_'+i for i in self.errors]
         self.assessments = ['absres', 'rmse', 'area']
@@ -715,6 +772,7 @@ class plotter:
         # Domain prediction columns
         pred_cols = [i for i in self.df.columns if 'Domain Prediction' in i]
 
+        self.confusion = df_confusion  # As given to save again
         if df_confusion is None:
             self.df_confusion = df[self.domains+pred_cols+['splitter']]
             self.pred_cols = pred_cols
@@ -725,41 +783,56 @@ class plotter:
         self.pred_cols = set(self.pred_cols)
 
     def generate(self):
+        '''
+        Write data and figures. Data for each figure is prepared here and
+        figures are drawn afterwards, in parallel when n_jobs is not one.
+        '''
+
+        jobs = []  # Plotting functions and their arguments
 
         # Write test data
-        self.df.to_csv(os.path.join(self.save, 'pred.csv'), index=False)
-        self.df_bin.to_csv(os.path.join(
-                                        self.save,
-                                        'pred_bins.csv',
-                                        ), index=False)
+        if self.data_format == 'text':
+            self.df.to_csv(os.path.join(self.save, 'pred.csv'), index=False)
+            self.df_bin.to_csv(os.path.join(
+                                            self.save,
+                                            'pred_bins.csv',
+                                            ), index=False)
+        else:
+            tables = {
+                      'pred': self.df,
+                      'pred_bins': self.df_bin,
+                      'plotter': {'precs': self.precs},
+                      }
+
+            if self.confusion is not None:
+                tables['pred_confusion'] = self.confusion
+
+            for key, value in tables.items():
+                artifacts.save(
+                               os.path.join(self.save, key),
+                               value,
+                               self.data_format == 'npz',
+                               )
 
         # For data used to fit regression model
         df = self.df[self.df['splitter'] == 'fit']
-        parity(
-               df,
-               self.save,
-               'fit_splitter',
-               )
+        jobs.append((parity, (df, self.save, 'fit_splitter')))
 
         # Confidence
-        confidence(self.df, self.save)
-        confidence(df, self.save, 'fit_splitter')
+        jobs.append((confidence, (self.df, self.save)))
+        jobs.append((confidence, (df, self.save, 'fit_splitter')))
 
         # CDF
-        cdf(df, 'splitter', self.save, 'fit_splitter')
+        jobs.append((cdf, (df, 'splitter', self.save, 'fit_splitter')))
 
         # Need to re-bin data by stdc not d for visual
         _, df = calculators.bin_data(df, self.bins, 'y_stdc_pred/std_y')
 
         # RMSE vs. stdc
-        rmse_vs_stdc(
-                     df,
-                     self.save,
-                     'fit_splitter',
-                     )
+        jobs.append((rmse_vs_stdc, (df, self.save, 'fit_splitter')))
 
         # Miscalibration area vs. RMSE
-        area_vs_rmse(self.df_bin, self.save)
+        jobs.append((area_vs_rmse, (self.df_bin, self.save)))
 
         # Prepare for confusion matrixes
         dy = self.df_confusion['splitter'] == 'fit'
@@ -792,11 +865,8 @@ class plotter:
             for group, df in self.df.groupby(i):
 
                 # Parity plot
-                parity(
-                       df,
-                       self.save,
-                       '{}_{}'.format(k, group),
-                       )
+                suffix = '{}_{}'.format(k, group)
+                jobs.append((parity, (df, self.save, suffix)))
 
                 # Need to re-bin data by stdc not d for visual
                 _, df = calculators.bin_data(
@@ -806,27 +876,23 @@ class plotter:
                                              )
 
                 # RMSE vs. stdc
-                rmse_vs_stdc(
-                             df,
-                             self.save,
-                             '{}_{}'.format(k, group),
-                             )
+                jobs.append((rmse_vs_stdc, (df, self.save, suffix)))
 
             # CDF Plots
-            cdf(self.df, i, self.save, k)
+            jobs.append((cdf, (self.df, i, self.save, k)))
 
             # Bins versus errors
-            bins(
-                 self.df,
-                 'd_pred',
-                 j,
-                 i,
-                 f,
-                 ename,
-                 cname,
-                 self.save,
-                 k,
-                 )
+            jobs.append((bins, (
+                                self.df,
+                                'd_pred',
+                                j,
+                                i,
+                                f,
+                                ename,
+                                cname,
+                                self.save,
+                                k,
+                                )))
 
             # PR curve
             pr_data = calculators.pr(
@@ -834,7 +900,7 @@ class plotter:
                                      self.df[i],
                                      self.precs,
                                      )
-            pr(pr_data, self.save, k)
+            jobs.append((pr, (pr_data, self.save, k)))
 
             # Confusion matrices
             for pred in self.pred_cols:
@@ -845,16 +911,95 @@ class plotter:
                     y = self.df_confusion.loc[:, i].values
                     y_pred = self.df_confusion.loc[:, pred].values
                     suffix = pred.replace(' ', '_').replace('/', '_div_')
-                    confusion(y, y_pred, self.save, suffix+'_splitter_all')
+                    jobs.append((confusion, (
+                                             y,
+                                             y_pred,
+                                             self.save,
+                                             suffix+'_splitter_all',
+                                             )))
 
                     # Confusion matrix for fit splitters
                     y = dy.loc[:, i].values
                     y_pred = dy.loc[:, pred].values
                     suffix = pred.replace(' ', '_').replace('/', '_div_')
-                    confusion(y, y_pred, self.save, suffix+'_splitter_fit')
+                    jobs.append((confusion, (
+                                             y,
+                                             y_pred,
+                                             self.save,
+                                             suffix+'_splitter_fit',
+                                             )))
 
                     # Confusion matrix for spliters that are not fit
                     y = dn.loc[:, i].values
                     y_pred = dn.loc[:, pred].values
                     suffix = pred.replace(' ', '_').replace('/', '_div_')
-                    confusion(y, y_pred, self.save, suffix+'_splitter_not_fit')
+                    jobs.append((confusion, (
+                                             y,
+                                             y_pred,
+                                             self.save,
+                                             suffix+'_splitter_not_fit',
+                                             )))
+
+        self.draw(jobs)
+
+    def draw(self, jobs):
+        '''
+        Run plotting functions.
+
+        inputs:
+            jobs = Plotting functions and their arguments.
+        '''
+
+        options = {
+                   'dpi': self.dpi,
+                   'formats': self.formats,
+                   'render': self.render,
+                   'data_format': self.data_format,
+                   }
+
+        if self.n_jobs == 1:
+            for i in jobs:
+                render(i, options)
+
+        else:
+            pool = worker_pool(self.n_jobs)
+            try:
+                func = partial(render, options=options, backend='Agg')
+                list(pool.imap_unordered(func, jobs))
+            finally:
+                pool.close()
+
+
+def load_plotter(path, save=None, **kwargs):
+    '''
+    Make a plotter from the binary data of a previous run.
+
+    inputs:
+        path = The location a plotter saved binary data.
+        save = The location to save plots (path if None).
+        kwargs = Other options for plotter.
+
+    outputs:
+        plot = The plotter.
+    '''
+
+    precs = artifacts.load(os.path.join(path, 'plotter'))['precs']
+    if precs is not None:
+        precs = np.asarray(precs).tolist()
+
+    df_confusion = os.path.join(path, 'pred_confusion')
+    if os.path.isdir(df_confusion):
+        df_confusion = artifacts.load(df_confusion)
+    else:
+        df_confusion = None
+
+    plot = plotter(
+                   artifacts.load(os.path.join(path, 'pred')),
+                   artifacts.load(os.path.join(path, 'pred_bins')),
+                   df_confusion,
+                   precs,
+                   path if save is None else save,
+                   **kwargs,
+                   )
+
+    return plot
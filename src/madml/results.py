@@ -0,0 +1,177 @@
+import pandas as pd
+import numpy as np
+
+
+class cv_results:
+    '''
+    Columnar storage of cross validation results. Numeric columns are
+    kept as typed arrays, text columns (e.g. splitters and ID/OD labels)
+    as small integer codes, and a pandas DataFrame is only made on demand.
+    '''
+
+    def __init__(self, capacity=0, float_dtype=np.float64):
+        '''
+        inputs:
+            capacity = The number of rows to preallocate (e.g. the total
+                       number of test cases for all splits).
+            float_dtype = The type used to store floating point columns.
+        '''
+
+        self.capacity = capacity
+        self.float_dtype = float_dtype
+        self.size = 0
+        self.columns = {}  # Column name to array
+        self.categories = {}  # Column name to list of text values
+
+    def grow(self, size):
+        '''
+        Make room for at least size rows.
+
+        inputs:
+            size = The number of rows needed.
+        '''
+
+        if size <= self.capacity:
+            return
+
+        self.capacity = max(size, 2*self.capacity)
+        for key, values in self.columns.items():
+            new = np.empty(self.capacity, dtype=values.dtype)
+            new[:self.size] = values[:self.size]
+            self.columns[key] = new
+
+    def encode(self, key, values):
+        '''
+        Get codes for text values and remember new categories.
+
+        inputs:
+            key = The column name.
+            values = The text values.
+
+        outputs:
+            codes = The index of each value in the column categories.
+        '''
+
+        categories = self.categories.setdefault(key, [])
+        labels, codes = np.unique(values, return_inverse=True)
+
+        lookup = {j: i for i, j in enumerate(categories)}
+        for i in labels:
+            if i not in lookup:
+                lookup[i] = len(categories)
+                categories.append(i)
+
+        codes = np.array([lookup[i] for i in labels])[codes]
+
+        return codes
+
+    def fill(self, key, start, stop):
+        '''
+        Mark rows of a column as missing like pandas does for splits
+        without that column.
+
+        inputs:
+            key = The column name.
+            start = The first row.
+            stop = The row after the last.
+        '''
+
+        if start >= stop:
+            return
+
+        values = self.columns[key]
+        if key in self.categories:
+            values[start:stop] = -1
+
+        elif values.dtype.kind == 'f':
+            values[start:stop] = np.nan
+
+        else:
+            values = values.astype(np.float64)
+            values[start:stop] = np.nan
+            self.columns[key] = values
+
+    def append(self, data):
+        '''
+        Add the rows for one split. Columns missing from some splits are
+        missing values for those rows.
+
+        inputs:
+            data = A mapping of column names to arrays or to scalars that
+                   are the same for every row (e.g. a dict or DataFrame).
+        '''
+
+        n = 0
+        for key in data:
+            if np.ndim(data[key]) > 0:
+                n = len(data[key])
+                break
+
+        if n == 0:
+            return
+
+        self.grow(self.size+n)
+        start, self.size = self.size, self.size+n
+
+        for key in data:
+            values = np.asarray(data[key])
+
+            if values.dtype.kind in 'OUS':
+                values = self.encode(key, np.broadcast_to(values, (n,)))
+                many = len(self.categories[key]) > 127
+                dtype = np.int32 if many else np.int8
+
+            elif values.dtype.kind == 'f':
+                dtype = self.float_dtype
+
+            else:
+                dtype = values.dtype
+
+            if key not in self.columns:
+                self.columns[key] = np.empty(self.capacity, dtype=dtype)
+                self.fill(key, 0, start)
+
+            elif key in self.categories:
+                if self.columns[key].itemsize < np.dtype(dtype).itemsize:
+                    self.columns[key] = self.columns[key].astype(dtype)
+
+            else:
+                dtype = np.result_type(self.columns[key], dtype)
+                self.columns[key] = self.columns[key].astype(dtype, copy=False)
+
+            self.columns[key][start:self.size] = values
+
+        for key in self.columns:
+            if key not in data:
+                self.fill(key, start, self.size)
+
+    def __len__(self):
+        return self.size
+
+    def to_frame(self, categorical=False):
+        '''
+        Make a DataFrame of all rows.
+
+        inputs:
+            categorical = Whether text columns are pandas categoricals
+                          instead of text.
+
+        outputs:
+            data = The results.
+        '''
+
+        data = {}
+        for key, values in self.columns.items():
+            values = values[:self.size]
+
+            if key in self.categories:
+                categories = np.array(self.categories[key], dtype=object)
+
+                if categorical:
+                    values = pd.Categorical.from_codes(values, categories)
+                else:
+                    values = np.where(values < 0, np.nan, categories[values])
+
+            data[key] = values
+
+        return pd.DataFrame(data, copy=False)
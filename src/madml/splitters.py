@@ -1,12 +1,41 @@
-from sklearn.model_selection import LeaveOneGroupOut
 from sklearn.preprocessing import StandardScaler
+from sklearn.neighbors import kneighbors_graph
+from madml.calculators import fingerprint
+from collections import OrderedDict
 from sklearn.utils import resample
 
 import pandas as pd
 import numpy as np
 
-import itertools
 import random
+import joblib
+
+# Cluster labels already found by this process
+clusters = OrderedDict()
+max_clusters = 32
+
+
+def mask_split(mask, indx=None):
+    '''
+    Get train and test indexes from a mask of testing cases.
+
+    inputs:
+        mask = True for testing cases.
+        indx = The indexes that mask is over (None for positions).
+
+    outputs:
+        train = The int32 training indexes.
+        test = The int32 testing indexes.
+    '''
+
+    train = np.flatnonzero(~mask)
+    test = np.flatnonzero(mask)
+
+    if indx is not None:
+        train = indx[train]
+        test = indx[test]
+
+    return train.astype(np.int32), test.astype(np.int32)
 
 
 class NoSplit:
@@ -26,7 +55,7 @@ class NoSplit:
         The training and testing indexes are the same.
         '''
 
-        indx = np.array(range(X.shape[0]))
+        indx = np.arange(X.shape[0], dtype=np.int32)
 
         yield indx, indx
 
@@ -65,28 +94,44 @@ class BootstrappedLeaveOneGroupOut:
         '''
 
         indx = np.arange(X.shape[0])
-        spltr = LeaveOneGroupOut()
         for rep in range(self.n_repeats):
 
             indx_sample = resample(indx)
-            X_sample = X[indx_sample, :]
-            y_sample = y[indx_sample]
-            g_sample = groups[indx_sample]
-            for train, test in spltr.split(X_sample, y_sample, g_sample):
-                yield indx_sample[train], indx_sample[test]
+            g_sample = np.unique(groups[indx_sample], return_inverse=True)[1]
+            for i in range(g_sample.max()+1):
+                yield mask_split(g_sample == i, indx_sample)
 
 
 class BootstrappedLeaveClusterOut:
     '''
     Custom splitting class which pre-clusters data and then splits
-    to folds.
+    to folds. Cluster labels are cached by data and clustering
+    parameters, so splitting the same data again (e.g. in nested CV or
+    for the final fit) does not cluster again.
+
+    For large datasets, use MiniBatchKMeans for clust or give
+    connect_neighbors with AgglomerativeClustering.
     '''
 
-    def __init__(self, clust, n_repeats, *args, **kwargs):
+    def __init__(
+                 self,
+                 clust,
+                 n_repeats,
+                 *args,
+                 connect_neighbors=None,
+                 cache=True,
+                 **kwargs,
+                 ):
         '''
         inputs:
             clust = The class of cluster from Scikit-learn.
             n_repeats = The number of times to apply splitting.
+            connect_neighbors = The number of nearest neighbors to connect
+                                for clusterers taking a connectivity
+                                (e.g. AgglomerativeClustering). Sparse
+                                connectivity avoids O(N^2) memory but
+                                can take longer.
+            cache = Whether to reuse cluster labels for the same data.
         '''
 
         self.clust = clust(*args, **kwargs)
@@ -96,8 +141,60 @@ class BootstrappedLeaveClusterOut:
             self.clust.n_jobs = 1
 
         self.n_repeats = n_repeats
+        self.connect_neighbors = connect_neighbors
+        self.cache = cache
         self.scaler = StandardScaler()
 
+    def cluster(self, X):
+        '''
+        Get cluster labels from scaled features.
+
+        inputs:
+            X = The features.
+
+        outputs:
+            labels = The cluster label of each case.
+        '''
+
+        params = self.clust.get_params()
+        if self.connect_neighbors is not None:
+            params.pop('connectivity', None)  # Made from X
+
+        key = (
+               fingerprint(X),
+               type(self.clust).__name__,
+               joblib.hash(params),
+               self.connect_neighbors,
+               )
+
+        if self.cache and (key in clusters):
+            clusters.move_to_end(key)
+            return clusters[key]
+
+        X = self.scaler.fit_transform(X)
+
+        if self.connect_neighbors is not None:
+            connectivity = kneighbors_graph(
+                                            X,
+                                            self.connect_neighbors,
+                                            include_self=False,
+                                            )
+            self.clust.set_params(connectivity=connectivity)
+
+        self.clust.fit(X)  # Do clustering
+        labels = np.asarray(self.clust.labels_)
+
+        # Do not keep the graph with copies of the splitter
+        if self.connect_neighbors is not None:
+            self.clust.set_params(connectivity=None)
+
+        if self.cache:
+            clusters[key] = labels
+            if len(clusters) > max_clusters:
+                clusters.popitem(last=False)
+
+        return labels
+
     def get_n_splits(self, X=None, y=None, groups=None):
         '''
         A method to return the number of splits.
@@ -116,18 +213,15 @@ class BootstrappedLeaveClusterOut:
             A generator for train and test splits.
         '''
 
-        X = self.scaler.fit_transform(X)
-        self.clust.fit(X)  # Do clustering
-
         # Get splits based on cluster labels
-        df = pd.DataFrame(X)
-        df['cluster'] = self.clust.labels_
-        cluster_order = list(set(self.clust.labels_))
+        labels = self.cluster(X)
+        cluster_order = list(set(labels))
         random.shuffle(cluster_order)
-        df = df.sample(frac=1)
 
-        # Randomize cluster order
-        df = [df.loc[df['cluster'] == i].index.tolist() for i in cluster_order]
+        # Randomize case order then cluster order
+        indx = np.random.permutation(labels.shape[0]).astype(np.int32)
+        labels = labels[indx]
+        groups = [indx[labels == i] for i in cluster_order]
 
         self.n_splits = len(cluster_order)
         range_splits = range(self.n_splits)
@@ -135,15 +229,12 @@ class BootstrappedLeaveClusterOut:
         # Do for requested repeats
         for rep in range(self.n_repeats):
 
-            sub = [resample(i) for i in df]  # Shuffle
+            sub = [resample(i) for i in groups]  # Shuffle
             for i in range_splits:
 
                 test = sub[i]  # Test
                 train = sub[:i]+sub[i+1:]  # Train
-                train = list(itertools.chain.from_iterable(train))
-
-                train = np.array(train)
-                test = np.array(test)
+                train = np.concatenate(train) if train else indx[:0]
 
                 yield train, test
 
@@ -175,20 +266,11 @@ class LeaveTargetQuantileOut:
         one of the bins out while training on the rest.
         '''
 
-        indx = np.arange(X.shape[0])
-
-        df = pd.DataFrame()
-        df['indx'] = indx
-        df['y'] = y
-        df['bin'] = pd.qcut(
-                            df['y'].rank(method='first'),
-                            self.n_splits
-                            )
-
-        for group, values in df.groupby('bin'):
-
-            test = values['indx'].values
-            train = [i for i in df['indx'].values if i not in test]
-            train = np.array(train)
+        bins = pd.qcut(
+                       pd.Series(y).rank(method='first'),
+                       self.n_splits,
+                       labels=False,
+                       ).to_numpy()
 
-            yield train, test
+        for i in range(self.n_splits):
+            yield mask_split(bins == i)
@@ -1,10 +1,10 @@
 import pandas as pd
-import dill
+import joblib
 
 df = pd.read_csv('/mnt/test.csv')
 
-with open('model.dill', 'rb') as handle:
-    model = dill.load(handle)
+# Saved with combine.export and memory mapped for a fast start
+model = joblib.load('model.joblib', mmap_mode='r')
 
 df = model.predict(df.values)
 df.to_csv('/mnt/prediction.csv', index=False)
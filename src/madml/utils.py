@@ -1,9 +1,257 @@
 from pathos.multiprocessing import ProcessingPool as Pool
+from pathos.pools import _ProcessPool
+from pathos.helpers import mp
+from collections import OrderedDict
 from functools import partial
 from tqdm import tqdm
+
+import numpy as np
+
+import tempfile
+import weakref
+import atexit
+import shutil
 import sys
 import os
 
+# Pools that are still running in this process
+live_pools = weakref.WeakSet()
+
+# Arrays already mapped by this process
+attached = OrderedDict()
+max_attached = 16
+
+
+def attach(path):
+    '''
+    Memory map an array published by shared_array.
+
+    inputs:
+        path = The location of the published array.
+
+    outputs:
+        x = The read only array.
+    '''
+
+    if path in attached:
+        attached.move_to_end(path)
+    else:
+        # Parents remove published files, so workers drop their maps
+        for i in [i for i in attached if not os.path.isfile(i)]:
+            del attached[i]
+
+        attached[path] = np.asarray(np.load(path, mmap_mode='r'))
+
+        if len(attached) > max_attached:
+            attached.popitem(last=False)
+
+    return attached[path]
+
+
+class shared_array:
+    '''
+    Publish an array once as a memory mapped file. When pickled, only the
+    location of the file is sent and workers map the same memory.
+    '''
+
+    def __init__(self, x):
+        '''
+        inputs:
+            x = The array to publish.
+        '''
+
+        x = np.asarray(x)
+
+        # Use memory backed storage when it has room (often small in docker)
+        top = None
+        if os.path.isdir('/dev/shm'):
+            if shutil.disk_usage('/dev/shm').free > x.nbytes:
+                top = '/dev/shm'
+
+        self.top = self.path = None
+        try:
+            self.save(x, top)
+        except OSError:
+            if top is None:
+                raise
+
+            self.close()
+            self.save(x, None)
+
+    def save(self, x, top):
+        '''
+        Write the array to a new directory.
+
+        inputs:
+            x = The array to publish.
+            top = The parent directory or None for the default.
+        '''
+
+        self.top = tempfile.mkdtemp(prefix='madml_', dir=top)
+        self.path = os.path.join(self.top, 'array.npy')
+
+        np.save(self.path, x, allow_pickle=False)
+
+    def __reduce__(self):
+        return (attach, (self.path,))
+
+    def close(self):
+        '''
+        Remove the published array.
+        '''
+
+        attached.pop(self.path, None)
+
+        if self.top is not None:
+            shutil.rmtree(self.top, ignore_errors=True)
+
+
+def share(x):
+    '''
+    Publish an array if it can be memory mapped.
+
+    inputs:
+        x = The array.
+
+    outputs:
+        x = A shared_array or the original object.
+    '''
+
+    if isinstance(x, np.ndarray) and (x.dtype != object):
+        return shared_array(x)
+
+    return x
+
+
+def unshare(*args):
+    '''
+    Remove any published arrays.
+
+    inputs:
+        args = Objects returned by share.
+    '''
+
+    for i in args:
+        if isinstance(i, shared_array):
+            i.close()
+
+
+class NoDaemonProcess(mp.Process):
+    '''
+    A worker process that may start its own pool of workers.
+    '''
+
+    @property
+    def daemon(self):
+        return False
+
+    @daemon.setter
+    def daemon(self, value):
+        pass
+
+
+class NoDaemonContext(type(mp.get_context())):
+    Process = NoDaemonProcess
+
+
+class worker_pool:
+    '''
+    A process pool that is kept alive between calls. The live pool is
+    not copied or pickled with the objects that hold it.
+    '''
+
+    def __init__(self, n_jobs=-1, nested=False):
+        '''
+        inputs:
+            n_jobs = The number of cores to use (-1 for all).
+            nested = Whether workers may start pools of their own.
+        '''
+
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        self.nested = nested
+        self.pool = None
+
+    def start(self):
+        '''
+        Lazily start the pool.
+
+        outputs:
+            pool = The running pool.
+        '''
+
+        if self.pool is None:
+            if self.nested:
+                self.pool = _ProcessPool(
+                                         self.n_jobs,
+                                         context=NoDaemonContext(),
+                                         )
+            else:
+                self.pool = _ProcessPool(self.n_jobs)
+
+            live_pools.add(self)
+
+        return self.pool
+
+    def imap(self, func, x):
+        '''
+        Map a function with results in the order of x.
+
+        inputs:
+            func = The function to run.
+            x = The items to iterate on.
+
+        outputs:
+            A generator of the results for each item.
+        '''
+
+        return self.start().imap(func, x)
+
+    def imap_unordered(self, func, x):
+        '''
+        Map a function with results in the order they finish.
+
+        inputs:
+            func = The function to run.
+            x = The items to iterate on.
+
+        outputs:
+            A generator of the results for each item.
+        '''
+
+        return self.start().imap_unordered(func, x)
+
+    def close(self):
+        '''
+        Stop the worker processes.
+        '''
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pool'] = None
+
+        return state
+
+    def __del__(self):
+        if (self.pool is not None) and (not sys.is_finalizing()):
+            self.pool.terminate()
+
+
+@atexit.register
+def close_pools():
+    '''
+    Stop pools before interpreter shutdown removes what they need.
+    '''
+
+    for i in list(live_pools):
+        if i.pool is not None:
+            i.pool.terminate()
+            i.pool = None
+
 
 def parallel(
              func,
@@ -11,6 +259,7 @@ def parallel(
              message=None,
              disable=False,
              n_jobs=-1,
+             pool=None,
              *args,
              **kwargs,
              ):
@@ -19,10 +268,11 @@ def parallel(
 
     inputs:
         func = The function to run.
-        x = The list of items to iterate on.
+        x = The items to iterate on (a generator is consumed lazily).
         message = A message to print.
         disable = Disable tqdm print.
         n_jobs = The number of cores to run on.
+        pool = A worker_pool to reuse instead of a new pool.
         args = Arguemnts for func.
         kwargs = Keyword arguments for func.
 
@@ -35,17 +285,20 @@ def parallel(
 
     part_func = partial(func, *args, **kwargs)
 
-    if n_jobs == -1:
-        n_jobs = os.cpu_count()
-    else:
-        n_jobs = n_jobs
-
-    with Pool(n_jobs) as pool:
-        data = list(tqdm(
-                         pool.imap(part_func, x),
-                         total=len(x),
-                         file=sys.stdout,
-                         disable=disable,
-                         ))
+    if pool is None:
+
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        else:
+            n_jobs = n_jobs
+
+        pool = Pool(n_jobs)
+
+    data = list(tqdm(
+                     pool.imap(part_func, x),
+                     total=len(x) if hasattr(x, '__len__') else None,
+                     file=sys.stdout,
+                     disable=disable,
+                     ))
 
     return data
@@ -0,0 +1,48 @@
+from madml import artifacts
+
+import pandas as pd
+import numpy as np
+import unittest
+import tempfile
+import os
+
+
+class ml_test(unittest.TestCase):
+
+    def test_save_load(self):
+        '''
+        Test that tables and nested data are loaded as saved.
+        '''
+
+        df = pd.DataFrame({
+                           'absres/std_y': np.random.uniform(size=5),
+                           'fold': np.arange(5),
+                           'in': np.arange(5) > 2,
+                           'domain': ['ID', 'OD', 'ID', np.nan, 'OD'],
+                           })
+
+        data = {
+                'ID': {'x': np.arange(3.0), 'y': [1.0, 2.0]},
+                'rmse/std_y': [[1, 2], [3]],
+                'gt': 0.5,
+                'X': np.random.uniform(size=(4, 2)),
+                }
+
+        for compress in [False, True]:
+            with tempfile.TemporaryDirectory() as path:
+                artifacts.save(os.path.join(path, 'df'), df, compress)
+                artifacts.save(os.path.join(path, 'data'), data, compress)
+
+                df_load = artifacts.load(os.path.join(path, 'df'))
+                data_load = artifacts.load(os.path.join(path, 'data'))
+
+                pd.testing.assert_frame_equal(df_load, df)
+
+                self.assertTrue(np.array_equal(data_load['X'], data['X']))
+                self.assertTrue(np.array_equal(data_load['ID']['y'], [1, 2]))
+                self.assertEqual(data_load['rmse/std_y'], [[1, 2], [3]])
+                self.assertEqual(data_load['gt'], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+from madml.models import combine, dissimilarity, calibration
+from sklearn.linear_model import LinearRegression
+from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import GroupKFold
+from sklearn.ensemble import BaggingRegressor
+from sklearn.model_selection import KFold
+from sklearn.pipeline import Pipeline
+from madml.assess import nested_cv
+
+import numpy as np
+import unittest
+import tempfile
+import os
+
+
+def quick_model():
+    '''
+    A small combined model.
+    '''
+
+    model = BaggingRegressor(LinearRegression(), n_estimators=5)
+    pipe = Pipeline(steps=[('model', model)])
+    gs_model = GridSearchCV(pipe, {}, cv=((slice(None), slice(None)),))
+
+    model = combine(
+                    gs_model,
+                    dissimilarity(dis='kde'),
+                    calibration(params=[0.0, 0.1]),
+                    [('fit', KFold(3))],
+                    )
+
+    return model
+
+
+class ml_test(unittest.TestCase):
+
+    def setUp(self):
+
+        # Runs write status.txt to the working directory
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+
+        self.X = np.random.uniform(size=(80, 3))
+        self.y = self.X.sum(axis=1)+np.random.normal(0, 0.1, 80)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_checkpoint(self):
+        '''
+        Test that restarted runs only reuse folds of the same setup.
+        '''
+
+        folds = os.path.join('checkpoint', 'folds')
+        splits = [('fit', KFold(4, shuffle=True))]
+
+        cv = nested_cv(quick_model(), self.X, self.y, splitters=splits)
+        df, _, _ = cv.test(checkpoint='checkpoint')
+
+        self.assertEqual(df.shape[0], 80)
+        self.assertEqual(len(os.listdir(folds)), 4)
+
+        # Restart after losing one fold
+        names = sorted(os.listdir(folds))
+        paths = [os.path.join(folds, i) for i in names]
+        os.remove(paths[0])
+        times = [os.path.getmtime(i) for i in paths[1:]]
+
+        cv = nested_cv(quick_model(), self.X, self.y, splitters=splits)
+        df, _, _ = cv.test(checkpoint='checkpoint')
+
+        self.assertEqual(df.shape[0], 80)
+        self.assertEqual(sorted(os.listdir(folds)), names)
+        self.assertEqual([os.path.getmtime(i) for i in paths[1:]], times)
+
+        # Other splitters do not reuse the splits or folds
+        splits = [('fit', KFold(6, shuffle=True))]
+        cv = nested_cv(quick_model(), self.X, self.y, splitters=splits)
+        df, _, _ = cv.test(checkpoint='checkpoint')
+
+        self.assertEqual(len(cv.splits), 6)
+        self.assertEqual(df['fold'].max(), 6)
+        self.assertEqual(df.shape[0], 80)
+        self.assertEqual(len(os.listdir(folds)), 10)
+
+    def test_checkpoint_groups(self):
+        '''
+        Test that restarted runs with other groups do not reuse folds.
+        '''
+
+        folds = os.path.join('checkpoint', 'folds')
+        splits = [('group', GroupKFold(2))]
+        g = np.repeat(['a', 'b', 'c', 'd'], 20)
+
+        cv = nested_cv(quick_model(), self.X, self.y, g, splitters=splits)
+        cv.test(checkpoint='checkpoint')
+
+        self.assertEqual(len(os.listdir(folds)), 2)
+
+        g = np.tile(['a', 'b', 'c', 'd'], 20)
+        cv = nested_cv(quick_model(), self.X, self.y, g, splitters=splits)
+        df, _, _ = cv.test(checkpoint='checkpoint')
+
+        for i, j in zip(cv.splits, GroupKFold(2).split(self.X, self.y, g)):
+            self.assertTrue((i[1] == j[1]).all())
+
+        self.assertEqual(df.shape[0], 80)
+        self.assertEqual(len(os.listdir(folds)), 4)
+
+    def test_outer_jobs(self):
+        '''
+        Test outer folds on their own workers against a serial run.
+        '''
+
+        splits = [('fit', KFold(2))]
+
+        cv = nested_cv(quick_model(), self.X, self.y, splitters=splits)
+        df, _, _ = cv.test()
+
+        # The full fit reuses the pool of the inner fits
+        self.assertIs(cv.model.pool, cv.pool)
+
+        cv = nested_cv(
+                       quick_model(),
+                       self.X,
+                       self.y,
+                       splitters=splits,
+                       n_jobs=2,
+                       outer_jobs=2,
+                       )
+
+        # Outer folds times inner cores stay within n_jobs
+        self.assertEqual(cv.outer_jobs, 2)
+        self.assertLessEqual(cv.outer_jobs*cv.inner_jobs, 2)
+
+        df_parallel, _, _ = cv.test()
+        self.assertEqual(df_parallel.shape[0], df.shape[0])
+
+        with open('status.txt', 'r') as handle:
+            self.assertEqual(handle.read().strip(), 'Ending fold 2/2')
+
+
+if __name__ == '__main__':
+    unittest.main()
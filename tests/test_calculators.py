@@ -0,0 +1,151 @@
+from sklearn.cluster import estimate_bandwidth
+from scipy.optimize import minimize
+from madml import calculators
+
+import pandas as pd
+import numpy as np
+import unittest
+
+
+class ml_test(unittest.TestCase):
+
+    def test_cdf_area(self):
+        '''
+        Test batched miscalibration areas against single group areas.
+        '''
+
+        x = np.random.normal(0, 1.5, 500)
+        g = np.random.randint(0, 5, 500)
+
+        labels, areas = calculators.cdf_area(x, g)
+
+        for i, j in zip(labels, areas):
+            self.assertAlmostEqual(calculators.cdf(x[g == i])[-1], j)
+
+    def test_prefix_metrics(self):
+        '''
+        Test incremental prefix metrics against direct calculations.
+        '''
+
+        y = np.abs(np.random.normal(0, 1, 200))
+        z = np.random.normal(0, 1.5, 200)
+
+        rmse, area = calculators.prefix_metrics(y, z)
+
+        for i in [1, 2, 50, 200]:
+            self.assertAlmostEqual(rmse[i-1], np.mean(y[:i]**2)**0.5)
+            self.assertAlmostEqual(area[i-1], calculators.cdf(z[:i])[-1])
+
+        # Areas between the exact prefix lengths are interpolated
+        rmse, sampled = calculators.prefix_metrics(y, z, max_points=50)
+
+        self.assertEqual(sampled.shape[0], 200)
+        self.assertAlmostEqual(sampled[0], area[0])
+        self.assertAlmostEqual(sampled[-1], area[-1])
+        self.assertLess(abs(np.mean(sampled)-np.mean(area)), 0.02)
+
+    def test_pr(self):
+        '''
+        Test that string and boolean domain labels give the same thresholds.
+        '''
+
+        d = np.random.uniform(size=300)
+        labels = np.random.uniform(size=300) > d
+
+        precs = [0.5, 0.9, 1.0]
+        data_bool = calculators.pr(d, labels, precs)
+        data_str = calculators.pr(d, np.where(labels, 'ID', 'OD'), precs)
+
+        self.assertEqual(data_bool, data_str)
+
+        for i in precs:
+            name = 'Minimum Precision: {}'.format(i)
+            self.assertGreaterEqual(data_bool[name]['Precision'], i)
+
+    def test_bandwidth(self):
+        '''
+        Test cached bandwidths against direct estimates.
+        '''
+
+        X = np.random.normal(size=(200, 3))
+
+        h = calculators.bandwidth(X)
+        self.assertAlmostEqual(h, estimate_bandwidth(X))
+        self.assertEqual(calculators.bandwidth(X.copy()), h)
+
+        for i in ['scott', 'silverman']:
+            self.assertGreater(calculators.bandwidth(X, i), 0.0)
+
+        with self.assertRaises(ValueError):
+            calculators.bandwidth(X, 'unknown')
+
+    def test_bin_data(self):
+        '''
+        Test bins and their statistics against pandas quantile bins.
+        '''
+
+        n = 300
+        data = pd.DataFrame({
+                             'd_pred': np.random.uniform(size=n),
+                             'y_stdc_pred/std_y': np.random.uniform(size=n),
+                             'absres/std_y': np.random.uniform(size=n),
+                             'z': np.random.normal(size=n),
+                             })
+
+        data_cv, bin_cv = calculators.bin_data(data, 10)
+        bins = pd.qcut(data_cv['d_pred'], 10)
+
+        self.assertTrue((data_cv['bin'] == bins).all())
+        self.assertEqual(bin_cv.shape[0], 10)
+
+        for i, j in bin_cv.iterrows():
+            values = data_cv[data_cv['bin'] == j['bin']]
+            rmse = np.mean(values['absres/std_y']**2)**0.5
+            area = calculators.cdf(values['z'])[-1]
+
+            self.assertEqual(j['count'], values.shape[0])
+            self.assertAlmostEqual(j['d_pred_max'], values['d_pred'].max())
+            self.assertAlmostEqual(j['rmse/std_y'], rmse)
+            self.assertAlmostEqual(j['cdf_area'], area)
+
+        # One bin when every value is the same
+        data['d_pred'] = 0.5
+        data_cv, bin_cv = calculators.bin_data(data, 10)
+        self.assertEqual(bin_cv['count'].tolist(), [n])
+
+    def test_set_llh(self):
+        '''
+        Test gradient based polynomial fits against nelder-mead.
+        '''
+
+        std = np.random.uniform(0.1, 2, 2000)
+        y = np.random.normal(0, 0.2+0.8*std)
+        y_pred = np.zeros(2000)
+
+        c = np.array([1.0, 2.0, 3.0])
+        self.assertTrue(np.allclose(
+                                    calculators.poly(c, std),
+                                    abs(c[0]+c[1]*std+c[2]*std**2),
+                                    ))
+
+        # Analytic gradient against finite differences
+        powers = np.vander(std, 3, increasing=True)
+        nll, grad = calculators.poly_nll(c, powers, y**2)
+        diff = [
+                (calculators.poly_nll(c+i, powers, y**2)[0]-nll)/1e-6
+                for i in 1e-6*np.eye(3)
+                ]
+        self.assertTrue(np.allclose(grad, diff, rtol=1e-3, atol=1e-6))
+
+        def nll(x):
+            return -np.mean(calculators.llh(std, y, x, calculators.poly))
+
+        for x in ([0.0, 1.0], [0.0, 1.0, 0.0]):
+            params = calculators.set_llh(y, y_pred, std, x, calculators.poly)
+            other = minimize(nll, x, method='nelder-mead').x
+
+            self.assertLessEqual(nll(params), nll(other)+1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
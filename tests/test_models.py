@@ -0,0 +1,248 @@
+from sklearn.linear_model import LinearRegression
+from sklearn.ensemble import BaggingRegressor
+from madml.models import predict_std, combine, dissimilarity, calibration
+from madml.models import assign_ground_truth, load_model, domain
+from sklearn.gaussian_process import GaussianProcessRegressor
+from madml.calculators import bin_data
+from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import KFold
+from scipy.spatial.distance import cdist
+from sklearn.pipeline import Pipeline
+from unittest import mock
+from madml import models
+
+import pandas as pd
+import numpy as np
+import unittest
+import tempfile
+import os
+
+
+class ml_test(unittest.TestCase):
+
+    def test_predict_std_bagging(self):
+        '''
+        Test ensemble spread when bagging members use feature subsets.
+        '''
+
+        X = np.random.uniform(size=(100, 6))
+        y = X.sum(axis=1)
+
+        model = BaggingRegressor(
+                                 LinearRegression(),
+                                 n_estimators=10,
+                                 max_features=0.5,
+                                 )
+        pipe = Pipeline(steps=[('model', model)])
+        gs_model = GridSearchCV(pipe, {}, cv=((slice(None), slice(None)),))
+        gs_model.fit(X, y)
+
+        model = gs_model.best_estimator_.named_steps['model']
+        std = []
+        for i, j in zip(model.estimators_, model.estimators_features_):
+            std.append(i.predict(X[:, j]))
+        std = np.std(std, axis=0)
+
+        self.assertTrue(np.allclose(predict_std(gs_model, X), std))
+        self.assertTrue(np.allclose(predict_std(gs_model, X, 2), std))
+
+    def test_combine_warm_start(self):
+        '''
+        Test that splits reuse what was found on all data.
+        '''
+
+        X = np.random.uniform(size=(100, 3))
+        y = X.sum(axis=1)+np.random.normal(0, 0.1, 100)
+
+        model = BaggingRegressor(LinearRegression(), n_estimators=5)
+        pipe = Pipeline(steps=[('model', model)])
+        grid = {'model__max_samples': [0.5, 1.0]}
+        gs_model = GridSearchCV(pipe, grid, cv=3)
+
+        model = combine(
+                        gs_model,
+                        dissimilarity(dis='kde'),
+                        calibration(params=[0.0, 0.1]),
+                        [('fit', KFold(3))],
+                        disable_tqdm=True,
+                        warm_start=True,
+                        )
+        model.fit(X, y, n_jobs=1)
+
+        self.assertEqual(model.data_cv.shape[0], X.shape[0])
+        self.assertEqual(model.predict(X).shape[0], X.shape[0])
+        self.assertIsNotNone(model.ds_model.bandwidth)
+
+        # Saved for serving
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'model.joblib')
+            model.export(path)
+            served = load_model(path)
+
+            self.assertIsNone(served.data_cv)
+            self.assertNotIn('Recall', served.domain_rmse.data)
+            self.assertTrue(served.predict(X).equals(model.predict(X)))
+
+        self.assertIsNotNone(model.data_cv)
+
+        # Chunks from a file give the same predictions in order
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'X.csv')
+            pd.DataFrame(X).to_csv(path, index=False)
+
+            chunks = pd.read_csv(
+                                 path,
+                                 chunksize=50,
+                                 float_precision='round_trip',
+                                 )
+            pred = list(model.predict_batches(chunks, chunk_size=30))
+
+        self.assertEqual([i.shape[0] for i in pred], [30, 20, 30, 20])
+
+        # Blocked products can differ in the last bits
+        pd.testing.assert_frame_equal(pd.concat(pred), model.predict(X))
+
+    def test_dissimilarity_neighbors(self):
+        '''
+        Test nearest neighbor dissimilarities against brute force.
+        '''
+
+        X_train = np.random.uniform(size=(50, 3))
+        y_train = X_train.sum(axis=1)
+        X = np.random.uniform(size=(10, 3))
+
+        # Training cases are not their own neighbors
+        dis_train = cdist(X_train, X_train)
+        np.fill_diagonal(dis_train, np.inf)
+        dis_train = np.sort(dis_train, axis=1)
+        dis = np.sort(cdist(X, X_train), axis=1)
+
+        for k in (1, 3):
+            model = dissimilarity(dis='euclidean', n_neighbors=k)
+            model.fit(X_train, y_train)
+
+            norm = np.max(np.mean(dis_train[:, :k], axis=1))
+            d = np.mean(dis[:, :k], axis=1)/norm
+            d = d/(d+1)
+
+            self.assertAlmostEqual(model.norm, norm)
+            self.assertTrue(np.allclose(model.predict(X), d))
+
+    def test_gpr(self):
+        '''
+        Test the sparse GP against the exact GP and warm started fits.
+        '''
+
+        X = np.random.uniform(size=(60, 2))
+        y = np.sin(3*X).sum(axis=1)+np.random.normal(0, 0.05, 60)
+        X_test = np.random.uniform(size=(20, 2))
+
+        # With every training case inducing it is the exact GP
+        model = dissimilarity(dis='gpr', n_inducing=60, n_restarts=2)
+        model.fit(X, y)
+
+        exact = GaussianProcessRegressor(model.kernel_, optimizer=None)
+        exact.fit(X, y)
+
+        mean, std = model.model.predict(X_test, return_std=True)
+        mean_exact, std_exact = exact.predict(X_test, return_std=True)
+
+        self.assertTrue(np.allclose(mean, mean_exact, atol=1e-6))
+        self.assertTrue(np.allclose(std, std_exact, atol=1e-6))
+
+        # Warm copies start from the fitted kernel without restarts
+        warm = model.warm_copy()
+        with mock.patch.object(models, 'fit_gpr', wraps=models.fit_gpr) as i:
+            warm.fit(X, y)
+
+        self.assertEqual(i.call_args[0][0], model.kernel_)
+        self.assertEqual(i.call_args[0][3], 0)
+
+    def test_assign_ground_truth(self):
+        '''
+        Test that each case gets the statistics and labels of its bin.
+        '''
+
+        n = 200
+        data = pd.DataFrame({
+                             'd_pred': np.random.uniform(size=n),
+                             'y_stdc_pred/std_y': np.random.uniform(size=n),
+                             'absres/std_y': np.random.uniform(size=n),
+                             'absres/mad_y': np.random.uniform(size=n),
+                             'z': np.random.normal(size=n),
+                             })
+        data['gt_absres'] = 0.5
+        data['gt_rmse'] = 0.6
+        data['gt_area'] = 0.2
+
+        data_cv, bin_cv = assign_ground_truth(*bin_data(data, 5))
+
+        self.assertEqual(data_cv.shape[0], n)
+        self.assertTrue((bin_cv['gt_rmse'] == 0.6).all())
+
+        for i, j in bin_cv.iterrows():
+            values = data_cv[data_cv['bin'] == j['bin']]
+            label = 'ID' if j['rmse/std_y'] < 0.6 else 'OD'
+
+            self.assertTrue((values['rmse/std_y'] == j['rmse/std_y']).all())
+            self.assertTrue((values['domain_rmse/std_y'] == label).all())
+
+        absres = np.where(data_cv['absres/mad_y'] < 0.5, 'ID', 'OD')
+        self.assertTrue((data_cv['domain_absres/mad_y'] == absres).all())
+
+    def test_calibration_partial_fit(self):
+        '''
+        Test streamed calibration against a fit on all cases.
+        '''
+
+        y_std = np.random.uniform(0.1, 2, 20000)
+        y = np.random.normal(0, 0.2+0.8*y_std)
+        y_pred = np.zeros(20000)
+
+        model = calibration(params=[0.0, 1.0])
+        model.fit(y, y_pred, y_std)
+
+        stream = calibration(params=[0.0, 1.0], max_buffer=200)
+        stream.fit(y[:1000], y_pred[:1000], y_std[:1000])
+        for i in range(1000, 20000, 1000):
+            j = slice(i, i+1000)
+            stream.partial_fit(y[j], y_pred[j], y_std[j])
+
+        self.assertLessEqual(stream.buffer.shape[0], 200)
+        self.assertTrue(np.allclose(stream.params, model.params, atol=0.01))
+
+        # Older cases are forgotten
+        y = np.random.normal(0, 0.5+0.3*y_std)
+        stream.forget = 0.9995
+        for i in range(0, 20000, 1000):
+            j = slice(i, i+1000)
+            stream.partial_fit(y[j], y_pred[j], y_std[j])
+
+        self.assertTrue(np.allclose(stream.params, [0.5, 0.3], atol=0.1))
+
+    def test_domain_partial_fit(self):
+        '''
+        Test added observations against a fit on all of them.
+        '''
+
+        d = np.round(np.random.normal(size=2000), 2)
+        labels = np.where(np.random.uniform(size=2000) < 0.5+d/4, 'OD', 'ID')
+
+        model = domain(precs=[0.5, 0.9])
+        model.fit(d, labels)
+
+        other = domain(precs=[0.5, 0.9])
+        other.fit(d[:500], labels[:500])
+        for i in range(500, 2000, 100):
+            other.partial_fit(d[i:i+100], labels[i:i+100] == 'ID')
+
+        pred = other.predict(d)
+        self.assertTrue(pred.equals(model.predict(d)))
+        self.assertTrue((other.scores == np.sort(d)).all())
+
+        for key, value in model.data.items():
+            self.assertEqual(other.data[key], value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+from sklearn.linear_model import LinearRegression
+from sklearn.model_selection import GridSearchCV
+from madml.models import combine, dissimilarity, calibration
+from madml.plots import load_plotter
+from sklearn.ensemble import BaggingRegressor
+from sklearn.model_selection import KFold
+from sklearn.pipeline import Pipeline
+
+import numpy as np
+import unittest
+import tempfile
+import os
+
+
+class ml_test(unittest.TestCase):
+
+    def test_plot_options(self):
+        '''
+        Test data only and parallel vector figure output.
+        '''
+
+        X = np.random.uniform(size=(100, 3))
+        y = X.sum(axis=1)+np.random.normal(0, 0.1, 100)
+
+        model = BaggingRegressor(LinearRegression(), n_estimators=5)
+        pipe = Pipeline(steps=[('model', model)])
+        gs_model = GridSearchCV(pipe, {}, cv=((slice(None), slice(None)),))
+
+        model = combine(
+                        gs_model,
+                        dissimilarity(dis='kde'),
+                        calibration(params=[0.0, 0.1]),
+                        [('fit', KFold(3))],
+                        disable_tqdm=True,
+                        )
+        model.fit(X, y, n_jobs=1)
+
+        with tempfile.TemporaryDirectory() as save:
+            model.plot(save, render=False)
+            names = os.listdir(save)
+
+            self.assertIn('parity_fit_splitter.json', names)
+            self.assertFalse([i for i in names if i.endswith('.png')])
+
+        with tempfile.TemporaryDirectory() as save:
+            model.plot(save, formats=['svg'], n_jobs=2)
+            names = os.listdir(save)
+
+            self.assertIn('parity_fit_splitter.svg', names)
+            self.assertIn('parity_fit_splitter_legend.svg', names)
+            self.assertFalse([i for i in names if i.endswith('.png')])
+
+        # Plot again from binary data
+        with tempfile.TemporaryDirectory() as save:
+            model.plot(save, render=False, data_format='npy')
+            self.assertIn('manifest.json', os.listdir(save+'/pred'))
+
+            with tempfile.TemporaryDirectory() as again:
+                plot = load_plotter(
+                                    save,
+                                    again,
+                                    render=False,
+                                    data_format='npy',
+                                    )
+                plot.generate()
+
+                names = sorted(os.listdir(again))
+                self.assertEqual(names, sorted(os.listdir(save)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+from madml.results import cv_results
+
+import pandas as pd
+import numpy as np
+import unittest
+
+
+class ml_test(unittest.TestCase):
+
+    def test_cv_results(self):
+        '''
+        Test stored splits against concatenated frames.
+        '''
+
+        results = cv_results(5)
+        frames = []
+        for i in range(4):
+            data = {
+                    'index': np.arange(3),
+                    'splitter': 'split_{}'.format(i % 2),
+                    'domain': np.where(np.arange(3) > i, 'ID', 'OD'),
+                    'fold': i,
+                    'y': np.random.normal(size=3),
+                    }
+
+            results.append(data)
+            results.append({})
+            frames.append(pd.DataFrame(data))
+
+        frame = pd.concat(frames).reset_index(drop=True)
+
+        self.assertEqual(len(results), 12)
+        self.assertEqual(results.columns['domain'].dtype, np.int8)
+        self.assertTrue(results.to_frame().equals(frame))
+
+        categories = results.to_frame(categorical=True)['splitter']
+        categories = list(categories.cat.categories)
+        self.assertEqual(categories, ['split_0', 'split_1'])
+
+        # Columns only in some splits
+        results.append({'other': np.ones(2, dtype=int), 'splitter': 'a'})
+        frame = pd.concat([
+                           frame,
+                           pd.DataFrame({'other': [1, 1], 'splitter': 'a'}),
+                           ]).reset_index(drop=True)
+
+        self.assertTrue(results.to_frame().equals(frame))
+
+
+if __name__ == '__main__':
+    unittest.main()
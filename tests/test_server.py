@@ -0,0 +1,67 @@
+from madml.hosting.server import model_server, model_client
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import numpy as np
+import unittest
+
+
+class dummy_model:
+    '''
+    Stands in for a fitted combine model.
+    '''
+
+    def __init__(self):
+        self.calls = 0
+
+    def predict(self, X):
+        self.calls += 1
+
+        y = X.sum(axis=1)
+
+        df = pd.DataFrame()
+        df['y_pred'] = y
+        df['domain'] = np.where(y > 1.0, 'OD', 'ID')
+
+        return df
+
+
+class ml_test(unittest.TestCase):
+
+    def test_server(self):
+        '''
+        Test batched predictions from concurrent clients.
+        '''
+
+        model = dummy_model()
+        X = [np.random.uniform(size=(i, 3)) for i in range(1, 41)]
+
+        with model_server(model, max_wait=0.05) as server:
+
+            client = model_client(server.url)
+            pred = client.predict(X[0])
+            self.assertTrue(pred.equals(model.predict(X[0])))
+
+            # Bad input does not stop the server
+            with self.assertRaises(RuntimeError):
+                client.predict(np.ones(3))
+
+            clients = [model_client(server.url) for i in range(8)]
+            with ThreadPoolExecutor(8) as pool:
+                preds = list(pool.map(
+                                      lambda i: clients[i % 8].predict(X[i]),
+                                      range(len(X)),
+                                      ))
+
+            for i, j in zip(X, preds):
+                self.assertTrue(np.allclose(j['y_pred'], i.sum(axis=1)))
+                self.assertEqual(list(j.columns), ['y_pred', 'domain'])
+
+            for i in [client]+clients:
+                i.close()
+
+        self.assertLess(model.calls, len(X)+4)
+
+
+if __name__ == '__main__':
+    unittest.main()
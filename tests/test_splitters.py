@@ -0,0 +1,88 @@
+from madml.splitters import BootstrappedLeaveOneGroupOut
+from madml.splitters import BootstrappedLeaveClusterOut
+from sklearn.cluster import AgglomerativeClustering
+from madml.splitters import LeaveTargetQuantileOut
+from sklearn.cluster import KMeans
+from madml import splitters
+
+import numpy as np
+import unittest
+import copy
+
+
+class ml_test(unittest.TestCase):
+
+    def test_splitters(self):
+        '''
+        Test that splits partition the (sampled) cases.
+        '''
+
+        X = np.random.uniform(size=(200, 3))
+        y = np.random.normal(size=200)
+        g = np.random.randint(0, 4, 200)
+
+        splits = list(LeaveTargetQuantileOut(5).split(X, y))
+        self.assertEqual(len(splits), 5)
+
+        tests = np.sort(np.concatenate([i[1] for i in splits]))
+        self.assertTrue((tests == np.arange(200)).all())
+
+        for train, test in splits:
+            self.assertEqual(train.dtype, np.int32)
+            self.assertEqual(test.shape[0], 40)
+            self.assertTrue((np.sort(np.append(train, test)) == tests).all())
+
+            # No training target is within the range of the testing ones
+            inside = (y[train] > y[test].min()) & (y[train] < y[test].max())
+            self.assertFalse(inside.any())
+
+        spltr = BootstrappedLeaveOneGroupOut(2, g)
+        splits = list(spltr.split(X, y, g))
+        self.assertEqual(len(splits), 8)
+
+        for train, test in splits:
+            self.assertEqual(np.unique(g[test]).shape[0], 1)
+            self.assertNotIn(g[test[0]], g[train])
+
+        spltr = BootstrappedLeaveClusterOut(KMeans, 2, n_clusters=3, n_init=1)
+        splits = list(spltr.split(X))
+        self.assertEqual(len(splits), 6)
+
+        for train, test in splits:
+            self.assertEqual(train.dtype, np.int32)
+            self.assertEqual(train.shape[0]+test.shape[0], 200)
+
+    def test_cluster_cache(self):
+        '''
+        Test that splitting the same data again reuses cluster labels.
+        '''
+
+        X = np.random.uniform(size=(300, 3))
+
+        spltr = splitters.BootstrappedLeaveClusterOut(
+                                                      AgglomerativeClustering,
+                                                      1,
+                                                      n_clusters=3,
+                                                      connect_neighbors=10,
+                                                      )
+
+        labels = spltr.cluster(X)
+        size = len(splitters.clusters)
+        self.assertEqual(np.unique(labels).shape[0], 3)
+        self.assertIsNone(spltr.clust.connectivity)
+
+        # Copies (e.g. in combine) find the same labels in the cache
+        other = copy.deepcopy(spltr)
+        other.clust.fit = None
+        self.assertIs(other.cluster(X), labels)
+        self.assertEqual(len(splitters.clusters), size)
+
+        # Different data or parameters are clustered again
+        self.assertEqual(spltr.cluster(X[:200]).shape[0], 200)
+        spltr.clust.set_params(n_clusters=2)
+        self.assertEqual(np.unique(spltr.cluster(X)).shape[0], 2)
+        self.assertEqual(len(splitters.clusters), size+2)
+
+
+if __name__ == '__main__':
+    unittest.main()
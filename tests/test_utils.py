@@ -0,0 +1,79 @@
+from madml.utils import worker_pool, parallel, share, unshare
+from unittest import mock
+from madml import utils
+
+import numpy as np
+import unittest
+import os
+
+
+def row_sum(i, X):
+    return X[i].sum()
+
+
+class ml_test(unittest.TestCase):
+
+    def test_shared_pool(self):
+        '''
+        Test reusing a pool with arrays published once.
+        '''
+
+        X = np.random.uniform(size=(100, 5))
+        pool = worker_pool(2)
+
+        for _ in range(2):
+            X_shared = share(X)
+            out = parallel(
+                           row_sum,
+                           list(range(10)),
+                           disable=True,
+                           pool=pool,
+                           X=X_shared,
+                           )
+            unshare(X_shared)
+
+            self.assertTrue(np.allclose(out, X[:10].sum(axis=1)))
+
+        pool.close()
+
+    def test_shared_files(self):
+        '''
+        Test stale maps and arrays that do not fit in shared memory.
+        '''
+
+        X = np.random.uniform(size=(100, 5))
+
+        # Workers drop maps of files removed by the parent
+        X_shared = share(X)
+        utils.attach(X_shared.path)
+        os.remove(X_shared.path)
+
+        other = share(X)
+        utils.attach(other.path)
+
+        self.assertNotIn(X_shared.path, utils.attached)
+        self.assertIn(other.path, utils.attached)
+        unshare(X_shared, other)
+
+        # Full shared memory falls back to a disk directory
+        save = np.save
+
+        def full(path, *args, **kwargs):
+            if path.startswith('/dev/shm'):
+                raise OSError(28, 'No space left on device')
+
+            save(path, *args, **kwargs)
+
+        with mock.patch.object(utils.np, 'save', side_effect=full):
+            X_shared = share(X)
+
+        self.assertFalse(X_shared.path.startswith('/dev/shm'))
+        self.assertTrue(np.array_equal(utils.attach(X_shared.path), X))
+
+        top = X_shared.top
+        unshare(X_shared)
+        self.assertFalse(os.path.isdir(top))
+
+
+if __name__ == '__main__':
+    unittest.main()